@@ -0,0 +1,49 @@
+"""
+Time the compilation of vega specs with many data sources, which are rewritten
+in one pass over the graph of their sources.
+
+    python benchmarks/bench_compiler.py [N ...]
+
+Each spec has one ibis data source and N derived data, half of them chained
+after each other and half reading the ibis data directly, like the data of
+layered and faceted charts.
+"""
+import sys
+import timeit
+
+import ibis
+import pandas
+
+from ibis_vega_transform.compiler import _transform
+from ibis_vega_transform.globals import DATA_NAME_PREFIX
+from ibis_vega_transform.registry import expression_registry
+
+
+def spec(key: str, n: int) -> dict:
+    root = f"{DATA_NAME_PREFIX}{key}"
+    data = [{"name": root}]
+    for i in range(n):
+        source = data[-1]["name"] if i % 2 else root
+        data.append(
+            {
+                "name": f"data_{i}",
+                "source": source,
+                "transform": [{"type": "filter", "expr": f"datum.a > {i}"}],
+            }
+        )
+    return {"data": data}
+
+
+def main(sizes) -> None:
+    expr = ibis.pandas.connect({"t": pandas.DataFrame({"a": [1, 2, 3]})}).table("t")
+    key = expression_registry.register(expr)
+    for n in sizes:
+        s = spec(key, n)
+        number = max(1, 1000 // n)
+        times = timeit.repeat(lambda: _transform(s, None), number=number, repeat=5)
+        seconds = min(times)
+        print(f"N={n}: {seconds / number * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [100, 300, 1000])
@@ -17,10 +17,28 @@ import IPython
 from .altair_data_transformer import altair_data_transformer
 from .altair_monkeypatch import monkeypatch_altair
 from .altair_renderer import altair_renderer
+from .cache import cache_stats, invalidate_cache, set_cache_max_bytes
 from .compiler import compiler_target_function
 from .core import apply
-from .globals import _expr_map, set_fallback, enable_debug, disable_debug
-from .query import query_target_func
+from .pool import close_pools, configure_pool
+from .globals import (
+    set_fallback,
+    set_fallback_sample,
+    set_result_encoding,
+    set_stream_batch_size,
+    set_downsampling,
+    set_prefetch,
+    set_selection_table_threshold,
+    set_preview_sample,
+    set_rollups,
+    set_crossfilter_resolution,
+    enable_debug,
+    disable_debug,
+)
+from .query import batch_query_target_func, query_target_func
+from .registry import registry_stats, set_registry_max_size
+from .rollup import drop_rollups
+from .selection_tables import drop_selection_tables
 
 
 ##
@@ -32,6 +50,7 @@ kernel = getattr(ipython, "kernel", None) if ipython else None
 
 if kernel:
     kernel.comm_manager.register_target("queryibis", query_target_func)
+    kernel.comm_manager.register_target("queryibis:batch", batch_query_target_func)
     kernel.comm_manager.register_target(
         "ibis_vega_transform:compiler", compiler_target_function
     )
@@ -72,7 +91,24 @@ def _load_jupyter_server_extension(server_app):
 
 __all__ = [
     "set_fallback",
-    "_expr_map",
+    "set_fallback_sample",
+    "set_result_encoding",
+    "set_stream_batch_size",
+    "set_downsampling",
+    "set_prefetch",
+    "set_selection_table_threshold",
+    "set_preview_sample",
+    "set_rollups",
+    "set_crossfilter_resolution",
+    "drop_rollups",
+    "drop_selection_tables",
+    "set_cache_max_bytes",
+    "invalidate_cache",
+    "cache_stats",
+    "set_registry_max_size",
+    "registry_stats",
+    "configure_pool",
+    "close_pools",
     "apply",
     "__version__",
     "version_info",
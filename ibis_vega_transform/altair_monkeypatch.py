@@ -1,4 +1,7 @@
 from ibis_vega_transform.globals import reset_debug
+import collections
+import threading
+import typing
 import warnings
 
 import altair
@@ -23,9 +26,7 @@ def monkeypatch_altair():
         """
         if data is not None and isinstance(data, ibis.Expr):
             reset_debug()
-            expr = data
-            data = empty_dataframe(expr)
-            data.ibis = expr
+            data = empty_dataframe(data)
 
         return original_chart_init(self, data=data, *args, **kwargs)
 
@@ -39,10 +40,35 @@ def monkeypatch_altair():
     altair.Chart.to_dict = updated_chart_to_dict
 
 
+# Number of empty dataframes to keep, for the expressions charts were
+# most recently built from
+MAX_FRAMES = 64
+
+# Empty dataframes by the id of their expression. The expressions are kept
+# alive by their dataframe, so their ids are not reused while they are cached.
+_frames: "collections.OrderedDict[int, pandas.DataFrame]" = collections.OrderedDict()
+_frames_lock = threading.Lock()
+
+
 def empty_dataframe(expr: ibis.Expr) -> pandas.DataFrame:
     """
-    Creates an empty DF for a ibis expression, based on the schema
+    Creates an empty DF for a ibis expression, based on the schema,
+    with the expression set as its `ibis` attribute.
+
+    Layered and concatenated charts build many charts from the same expression,
+    so the dataframe is cached.
 
     https://github.com/ibis-project/ibis/issues/1676#issuecomment-441472528
     """
-    return expr.schema().apply_to(pandas.DataFrame(columns=expr.columns))
+    with _frames_lock:
+        frame: typing.Optional[pandas.DataFrame] = _frames.get(id(expr))
+        if frame is not None and frame.ibis is expr:
+            _frames.move_to_end(id(expr))
+            return frame
+    frame = expr.schema().apply_to(pandas.DataFrame(columns=expr.columns))
+    frame.ibis = expr
+    with _frames_lock:
+        _frames[id(expr)] = frame
+        while len(_frames) > MAX_FRAMES:
+            _frames.popitem(last=False)
+    return frame
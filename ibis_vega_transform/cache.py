@@ -0,0 +1,184 @@
+"""
+Kernel side cache for the results of `queryibis` requests.
+"""
+import collections
+import json
+import threading
+import typing
+
+__all__ = [
+    "ResultCache",
+    "result_cache",
+    "extent_cache",
+    "expression_cache",
+    "compiled_spec_cache",
+    "cache_key",
+    "set_cache_max_bytes",
+    "invalidate_cache",
+    "cache_stats",
+]
+
+# By default, keep up to 256 MB of serialized query results around.
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+CacheKey = typing.Tuple[str, str]
+
+
+def cache_key(name: str, transforms: typing.Any, parameters: dict) -> CacheKey:
+    """
+    Create a cache key for a query, from the name of the root expression
+    and a canonical form of its transforms and data parameters.
+    """
+    canonical = json.dumps(
+        {"transform": transforms, "parameters": parameters},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return name, canonical
+
+
+class ResultCache:
+    """
+    A thread safe LRU cache of query results, bounded by the approximate
+    size in bytes of the cached values.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "collections.OrderedDict[CacheKey, typing.Tuple[typing.Any, int]]" = (
+            collections.OrderedDict()
+        )
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey) -> typing.Optional[typing.Any]:
+        """
+        Returns the cached values for the key, or None if they are not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: CacheKey, values: typing.Any, nbytes: int) -> None:
+        """
+        Store the values for the key, evicting the least recently used
+        entries until we are under the memory budget.
+
+        Results larger than the whole budget are not cached.
+        """
+        with self._lock:
+            self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (values, nbytes)
+            self._nbytes += nbytes
+            self._shrink()
+
+    def invalidate(self, name: typing.Optional[str] = None) -> None:
+        """
+        Drop all cached results for the expression `name`, or every cached
+        result if no name is given.
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+                self._nbytes = 0
+                return
+            for key in [k for k in self._entries if k[0] == name]:
+                self._remove(key)
+
+    def resize(self, max_bytes: int) -> None:
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink()
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def _shrink(self) -> None:
+        while self._nbytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+            self._evictions += 1
+
+
+result_cache = ResultCache()
+
+# Extents of binned fields, keyed by the SQL of the extent query
+extent_cache = ResultCache(max_bytes=16 * 1024 * 1024)
+
+# Expressions built by `apply` for each prefix of a list of transforms.
+# Each expression counts as one byte, so this holds up to 1024 expressions.
+expression_cache = ResultCache(max_bytes=1024)
+
+# Vega specs transformed by the compiler, keyed by a hash of the incoming spec
+compiled_spec_cache = ResultCache(max_bytes=64 * 1024 * 1024)
+
+
+def set_cache_max_bytes(max_bytes: int) -> None:
+    """
+    Set the memory budget of the query result cache. Setting it to 0
+    disables caching.
+    """
+    result_cache.resize(max_bytes)
+
+
+def invalidate_cache(expr: typing.Any = None) -> None:
+    """
+    Drop cached query results, for instance after the underlying table changed.
+
+    Cached bin extents are always cleared entirely, since they are not
+    stored by expression. Memoized expressions are cleared too, because
+    binned ones embed the extents. Rollups and crossfilter indexes of the
+    expressions are dropped.
+
+    Parameters
+    ----------
+    expr: Optional[ibis.Expr]
+        An ibis table or expression. The results of every chart reading the
+        tables it reads are invalidated. If not given, the whole cache is
+        cleared.
+    """
+    # Imported here, b/c these modules import this one through the registry
+    from .crossfilter import drop_indexes
+    from .registry import expression_registry
+    from .rollup import drop_rollups
+
+    names: typing.List[typing.Optional[str]] = [None]
+    if expr is not None:
+        names = list(expression_registry.keys_reading(expr))
+    for name in names:
+        result_cache.invalidate(name)
+        expression_cache.invalidate(name)
+        drop_rollups(name)
+        drop_indexes(name)
+    extent_cache.invalidate()
+
+
+def cache_stats() -> typing.Dict[str, int]:
+    """
+    Returns the hit/miss counters and the memory usage of the result cache.
+    """
+    return result_cache.stats()
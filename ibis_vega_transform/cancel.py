@@ -0,0 +1,88 @@
+"""
+Cooperative cancellation of queries that have been superseded or aborted
+by the frontend.
+"""
+import contextlib
+import threading
+import typing
+
+__all__ = ["QueryCancelled", "CancelToken", "use_token", "current_token"]
+
+# Called when a query is cancelled. Whatever it returns is ignored.
+Hook = typing.Callable[[], object]
+
+
+class QueryCancelled(Exception):
+    """
+    Raised inside a query when it was cancelled.
+    """
+
+
+class CancelToken:
+    """
+    Tracks whether a query was cancelled, and runs the registered hooks
+    to interrupt it when it is.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._hooks: typing.List[Hook] = []
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            hooks, self._hooks = self._hooks, []
+        for hook in hooks:
+            try:
+                hook()
+            except Exception:
+                pass
+
+    def on_cancel(self, hook: Hook) -> typing.Callable[[], None]:
+        """
+        Register a hook to call when the token is cancelled. If it already
+        is, the hook is called right away.
+
+        Returns a function that unregisters the hook.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._hooks.append(hook)
+                return lambda: self._remove(hook)
+        hook()
+        return lambda: None
+
+    def check(self) -> None:
+        """
+        Raise `QueryCancelled` if the token was cancelled.
+        """
+        if self.cancelled:
+            raise QueryCancelled()
+
+    def _remove(self, hook: Hook) -> None:
+        with self._lock:
+            if hook in self._hooks:
+                self._hooks.remove(hook)
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def use_token(token: CancelToken) -> typing.Iterator[CancelToken]:
+    """
+    Make the token the current one for this thread within the `with` block.
+    """
+    previous = current_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def current_token() -> typing.Optional[CancelToken]:
+    return getattr(_local, "token", None)
@@ -1,14 +1,33 @@
+import collections
+import concurrent.futures
 import copy
+import hashlib
+import json
+import logging
 import re
 import typing
 
 import opentracing
 
-from .globals import DATA_NAME_PREFIX, _expr_map, debug
+from .cache import compiled_spec_cache
+from .globals import (
+    DATA_NAME_PREFIX,
+    debug,
+    get_downsampling,
+    get_prefetch,
+    get_rollups,
+)
+from .optimize import ALL, Columns, expression_fields
+from .query import executor, prefetch
+from .registry import expression_registry
+from .rollup import build_rollup, requirements
 from .tracer import tracer
+from .util import promote_list
 
 __all__ = ["compiler_target_function"]
 
+logger = logging.getLogger(__name__)
+
 # An empty vega spec to send when we get invalid data.
 EMPTY_VEGA = {
     "$schema": "https://vega.github.io/schema/vega/v5.json",
@@ -47,12 +66,37 @@ def compiler_target_function(comm, msg):
         debug("vega-spec:initial", spec)
 
         try:
-            with tracer.start_span("transform-vega", child_of=span) as transform_span:
-                updated_spec = _transform(spec, root_span)
-                transform_span.log_kv({"vega-spec:transformed": updated_spec})
-                span.log_kv({"vega-spec:transformed": updated_spec})
+            key = _spec_key(spec)
+            cached = compiled_spec_cache.get(key)
+            # Only use the cached spec if its expressions are still registered
+            if cached is not None and all(
+                k in expression_registry for k in cached[1]
+            ):
+                span.log_kv({"cache": "hit"})
+                expr_keys = cached[1]
+                updated_spec = _with_span(cached[0], root_span)
+            else:
+                with tracer.start_span(
+                    "transform-vega", child_of=span
+                ) as transform_span:
+                    compiled = _transform(spec, None)
+                    expr_keys = _expr_keys(compiled)
+                    compiled_spec_cache.put(
+                        key, (compiled, expr_keys), len(json.dumps(compiled))
+                    )
+                    updated_spec = _with_span(compiled, root_span)
+                    transform_span.log_kv({"vega-spec:transformed": updated_spec})
+                    span.log_kv({"vega-spec:transformed": updated_spec})
 
+            # The view keeps the comm open while it is rendered, so its
+            # expressions stay registered until it is closed
+            expression_registry.acquire(expr_keys)
+            comm.on_close(lambda msg: expression_registry.release(expr_keys))
             comm.send(updated_spec)
+            if get_prefetch():
+                _prefetch_initial_queries(updated_spec, root_span)
+            if get_rollups():
+                _plan_rollups(updated_spec)
         except ValueError as e:
             # If there was an error transforming the spec, which can happen
             # if we don't support all the required transforms, or if
@@ -62,6 +106,146 @@ def compiler_target_function(comm, msg):
             raise e
 
 
+def _prefetch_initial_queries(
+    spec: typing.Dict[str, typing.Any], root_span: object
+) -> None:
+    """
+    Start executing the queries the frontend will send once the view is created,
+    while it is being created.
+
+    We can only predict the parameters of a query if the data it depends on
+    are selections, which start out empty.
+    """
+    for data in spec["data"]:
+        for t in data.get("transform", []):
+            if t["type"] != "queryibis":
+                continue
+            parameters = _initial_parameters(spec, t)
+            if parameters is not None:
+                prefetch({**parameters, "span": root_span})
+
+
+def _initial_parameters(
+    spec: typing.Dict[str, typing.Any], transform: dict
+) -> typing.Optional[dict]:
+    """
+    The parameters the frontend sends for a `queryibis` transform before any
+    interaction, or None if they can't be known.
+    """
+    parameters: typing.Dict[str, typing.Any] = {"name": transform["name"]}
+    for key in ("transform", "downsample"):
+        if key in transform:
+            parameters[key] = copy.deepcopy(transform[key])
+    if "data" in transform:
+        used = _extract_used_data(transform.get("transform", []))
+        by_name = {data["name"]: data for data in spec["data"]}
+        for name in used:
+            data = by_name.get(name, {})
+            if not data or {"values", "source", "url"} & data.keys():
+                return None
+        # Every referenced data is passed both in the `data` parameter,
+        # and as a `:<data name>` parameter
+        parameters["data"] = {name: [] for name in used}
+        parameters.update({f":{name}": [] for name in used})
+    return parameters
+
+
+def _plan_rollups(spec: typing.Dict[str, typing.Any]) -> None:
+    """
+    Build rollups in the background, for the aggregations of the spec.
+
+    All the aggregations on the same expression share one rollup, whose
+    dimensions include the fields their selections filter on.
+    """
+    plans: typing.Dict[str, typing.Tuple[set, set]] = {}
+    for data in spec["data"]:
+        for t in data.get("transform", []):
+            if t["type"] != "queryibis" or not t.get("transform"):
+                continue
+            bindings = _selection_fields(spec, _extract_used_data(t["transform"]))
+            required = requirements(t["transform"], bindings)
+            if required is None:
+                continue
+            dimensions, measures = plans.setdefault(t["name"], (set(), set()))
+            dimensions |= required[0]
+            measures |= required[1]
+    for name, (dimensions, measures) in plans.items():
+        future = executor.submit(build_rollup, name, dimensions, measures)
+        future.add_done_callback(_log_rollup_error)
+
+
+def _log_rollup_error(future: concurrent.futures.Future) -> None:
+    # Nothing waits for the rollups, so report why one couldn't be built
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Failed to build a rollup", exc_info=future.exception())
+
+
+def _selection_fields(
+    spec: typing.Dict[str, typing.Any], names: typing.Iterable[str]
+) -> typing.Dict[str, typing.List[dict]]:
+    """
+    Bindings for the stores of vega-lite selections, with the fields they select
+    on and no values. The fields are the value of the `<selection>_tuple_fields` signal.
+    """
+    signals = {s["name"]: s for s in _walk_named(spec, "signals") if "name" in s}
+    bindings = {}
+    for name in names:
+        if not name.endswith("_store"):
+            continue
+        signal = signals.get(name[: -len("_store")] + "_tuple_fields", {})
+        if isinstance(signal.get("value"), list):
+            bindings[name] = [{"fields": signal["value"], "values": []}]
+    return bindings
+
+
+def _spec_key(spec: typing.Dict[str, typing.Any]) -> typing.Tuple[str, str]:
+    """
+    A stable key for an incoming spec, which also depends on the settings
+    that change how it is transformed.
+    """
+    canonical = json.dumps(
+        {"spec": spec, "downsampling": get_downsampling()},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return "spec", hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def _expr_keys(spec: typing.Dict[str, typing.Any]) -> typing.Set[str]:
+    """
+    The keys of the ibis expressions a transformed spec queries.
+    """
+    return {
+        t["name"]
+        for data in spec["data"]
+        for t in data.get("transform", [])
+        if t["type"] == "queryibis"
+    }
+
+
+def _with_span(
+    spec: typing.Dict[str, typing.Any], root_span: object
+) -> typing.Dict[str, typing.Any]:
+    """
+    Returns a copy of a transformed spec, where the `queryibis` transforms
+    reference the span of this render. Only the parts that change are copied.
+    """
+
+    def with_span(data: dict) -> dict:
+        transforms = data.get("transform")
+        if not transforms:
+            return data
+        return {
+            **data,
+            "transform": [
+                {**t, "span": root_span} if t["type"] == "queryibis" else t
+                for t in transforms
+            ],
+        }
+
+    return {**spec, "data": [with_span(data) for data in spec["data"]]}
+
+
 def _transform(
     spec: typing.Dict[str, typing.Any], root_span: object
 ) -> typing.Dict[str, typing.Any]:
@@ -73,75 +257,245 @@ def _transform(
     _transforms = {}  # Store references to ibis query transforms
     _root_expressions = {}  # Keep track of the sources backed in ibis expressions
 
-    # We iteratively pass through the data, looking
-    # for named ibis data sources and data sources that
-    # reference our named sources. When we can pass through
-    # the entire set of data without encountering one,
-    # then we are done.
-    done = False
-    while not done:
-        for data in new["data"]:
-            # First check for named data which matches an initial
-            # ibis expression passed in directly via altair.
-            name = data.get("name", "")
-            if _is_ibis(name) and name not in _root_expressions:
-                key = _retrieve_expr_key(name)
-                new_transform = {"type": "queryibis", "name": key, "span": root_span}
-                # If the named data has transforms, set them
-                # in the ibis transform, and keep a reference
-                # to them in case we need to incorporate them
-                # into downstream data attributes.
-                old_transform = data.get("transform", None)
-                if old_transform:
-                    _transforms[name] = old_transform
-                    new_transform["transform"] = old_transform
-                data["transform"] = [new_transform]
-                _root_expressions[name] = name
-                break
-
-            # Next check to see if the data sources an upstream data set.
-            # If it is one of ours, transform that as well.
-            source = data.get("source", "")
-            if source and source in _root_expressions:
-                del data["source"]
-                source_transforms = _transforms.get(source, [])
-                old_transforms = data.get("transform", [])
-
-                # Rename "signal" to "signal_" because if vega
-                # sees a "signal" key on an object it will try to resolve it, instead of passing
-                # it into the transform
-                for t in old_transforms:
-                    if "signal" in t:
-                        t["signal_"] = t["signal"]
-                        del t["signal"]
-
-                new_transforms = source_transforms + old_transforms
-                data["transform"] = [
-                    {
-                        "type": "queryibis",
-                        "name": _retrieve_expr_key(_root_expressions[source]),
-                        "span": root_span,
-                        "data": "{"
-                        + ", ".join(
-                            f"{field}: data('{field}')"
-                            for field in _extract_used_data(new_transforms)
-                        )
-                        + "}",
-                        "transform": new_transforms,
-                    }
-                ]
-                _root_expressions[name] = _root_expressions[source]
-                _transforms[name] = new_transforms
-                break
-        # If we make it through the data sources without a `break`
-        # statement, there are no more data sources to transform,
-        # so we are done.
-        else:
-            done = True
+    # Build the graph of data sources, from each data to the data which
+    # use it as their source, and then visit it in topological order,
+    # starting from the named ibis data sources. Each data is rewritten once,
+    # after its source.
+    children: typing.Dict[str, typing.List[dict]] = collections.defaultdict(list)
+    for data in new["data"]:
+        source = data.get("source", "")
+        if source:
+            children[source].append(data)
 
+    queue: typing.Deque[dict] = collections.deque(
+        data for data in new["data"] if _is_ibis(data.get("name", ""))
+    )
+    visited: typing.Set[int] = set()
+    while queue:
+        data = queue.popleft()
+        if id(data) in visited:
+            continue
+        visited.add(id(data))
+        name = data.get("name", "")
+        queue.extend(children.get(name, []))
+
+        # First check for named data which matches an initial
+        # ibis expression passed in directly via altair.
+        if _is_ibis(name):
+            key = _retrieve_expr_key(name)
+            new_transform = {"type": "queryibis", "name": key, "span": root_span}
+            # If the named data has transforms, set them
+            # in the ibis transform, and keep a reference
+            # to them in case we need to incorporate them
+            # into downstream data attributes.
+            old_transform = data.get("transform", None)
+            if old_transform:
+                _transforms[name] = old_transform
+                new_transform["transform"] = old_transform
+            data["transform"] = [new_transform]
+            _root_expressions[name] = name
+            continue
+
+        # Otherwise the data sources an upstream data set which is one of ours,
+        # so transform that as well.
+        source = data.pop("source")
+        source_transforms = _transforms.get(source, [])
+        old_transforms = data.get("transform", [])
+
+        # Rename "signal" to "signal_" because if vega
+        # sees a "signal" key on an object it will try to resolve it, instead of passing
+        # it into the transform
+        for t in old_transforms:
+            if "signal" in t:
+                t["signal_"] = t["signal"]
+                del t["signal"]
+
+        new_transforms = source_transforms + old_transforms
+        data["transform"] = [
+            {
+                "type": "queryibis",
+                "name": _retrieve_expr_key(_root_expressions[source]),
+                "span": root_span,
+                "data": "{"
+                + ", ".join(
+                    f"{field}: data('{field}')"
+                    for field in _extract_used_data(new_transforms)
+                )
+                + "}",
+                "transform": new_transforms,
+            }
+        ]
+        _root_expressions[name] = _root_expressions[source]
+        _transforms[name] = new_transforms
+
+    if get_downsampling():
+        _add_downsampling(new)
     return _cleanup_spec(new)
 
 
+# Size of the chart to downsample to, when it isn't a number in the spec
+DEFAULT_SIZE = 1000
+
+# Scales on which pixels are evenly spaced in data space
+LINEAR_SCALES = {"linear", "time", "utc"}
+
+# Channels which don't change how a mark is drawn. Downsampled rows keep all
+# their fields, so these still show the fields of one of the merged rows.
+NON_VISUAL_CHANNELS = {
+    "tooltip",
+    "href",
+    "cursor",
+    "description",
+    "aria",
+    "ariaRole",
+    "ariaRoleDescription",
+}
+
+
+def _add_downsampling(spec: typing.Dict[str, typing.Any]) -> None:
+    """
+    Add a `downsample` parameter to the `queryibis` transform of data sources
+    which are only drawn by line or symbol marks, with continuous x and y scales.
+    """
+    width = _size(spec, "width")
+    height = _size(spec, "height")
+    scales = {
+        scale["name"]: scale.get("type", "linear")
+        for scale in _walk_named(spec, "scales")
+    }
+    facets: typing.Dict[str, typing.Tuple[str, typing.List[str]]] = {}
+    usages: typing.Dict[str, typing.List[typing.Optional[dict]]] = {}
+    # The fields of the selections that encodings test
+    selections = _selection_fields(spec, _extract_used_data(list(_walk_marks(spec))))
+
+    for mark in _walk_marks(spec):
+        from_ = mark.get("from", {})
+        if "facet" in from_:
+            facet = from_["facet"]
+            facets[facet["name"]] = (
+                facet["data"],
+                promote_list(facet.get("groupby", [])),
+            )
+            continue
+        data = from_.get("data")
+        if not data:
+            continue
+        groupby: typing.List[str] = []
+        if data in facets:
+            data, groupby = facets[data]
+        usages.setdefault(data, []).append(
+            _downsample_spec(mark, scales, groupby, width, height, selections)
+        )
+
+    for data in spec["data"]:
+        specs = usages.get(data.get("name"))
+        if not specs or any(s is None or s != specs[0] for s in specs):
+            continue
+        transforms = data.get("transform", [])
+        if transforms and transforms[0]["type"] == "queryibis":
+            transforms[0]["downsample"] = specs[0]
+
+
+def _downsample_spec(
+    mark: dict,
+    scales: typing.Dict[str, str],
+    groupby: typing.List[str],
+    width: int,
+    height: int,
+    selections: typing.Dict[str, typing.List[dict]],
+) -> typing.Optional[dict]:
+    """
+    The downsampling of the data of a mark, or None if it can't be downsampled.
+
+    Rows are only merged if they agree on every field the visual channels of the
+    mark read, including in conditions and signals. If we can't tell which
+    fields a channel reads, the data is not downsampled.
+    """
+    if mark.get("type") not in ("line", "symbol"):
+        return None
+    encode = mark.get("encode", {})
+    channels: typing.Dict[str, typing.Any] = {}
+    for properties in encode.values():
+        channels.update(properties)
+    x, y = channels.get("x", {}), channels.get("y", {})
+    for channel in (x, y):
+        if not isinstance(channel.get("field"), str):
+            return None
+        if scales.get(channel.get("scale")) not in LINEAR_SCALES:
+            return None
+    fields: typing.Set[str] = set()
+    for name, channel in channels.items():
+        if name in ("x", "y") or name in NON_VISUAL_CHANNELS:
+            continue
+        read = _channel_fields(channel, selections)
+        if read is ALL:
+            return None
+        fields |= read
+    return {
+        "mark": mark["type"],
+        "x": x["field"],
+        "y": y["field"],
+        "groupby": sorted(set(groupby) | fields),
+        "width": width,
+        "height": height,
+    }
+
+
+def _channel_fields(
+    channel: typing.Any, selections: typing.Dict[str, typing.List[dict]]
+) -> Columns:
+    """
+    The fields an encoding channel reads, from its field, signal and the tests
+    of its conditions, or ALL if we can't tell.
+    """
+    fields: typing.Set[str] = set()
+    for rule in promote_list(channel):
+        if not isinstance(rule, dict):
+            return ALL
+        for key in ("test", "signal"):
+            if key in rule:
+                read = expression_fields(rule[key], selections)
+                if read is ALL:
+                    return ALL
+                fields |= read
+        if "field" in rule:
+            if not isinstance(rule["field"], str):
+                return ALL
+            fields.add(rule["field"])
+    return fields
+
+
+def _size(spec: typing.Dict[str, typing.Any], name: str) -> int:
+    value = spec.get(name)
+    if not isinstance(value, (int, float)):
+        value = next(
+            (s.get("value") for s in spec.get("signals", []) if s.get("name") == name),
+            None,
+        )
+    if not isinstance(value, (int, float)) or value <= 0:
+        return DEFAULT_SIZE
+    return int(value)
+
+
+def _walk_marks(spec: dict) -> typing.Iterator[dict]:
+    """
+    Iterate over all marks of the spec, including those nested in group marks.
+    Group marks come before the marks they contain.
+    """
+    for mark in spec.get("marks", []):
+        yield mark
+        yield from _walk_marks(mark)
+
+
+def _walk_named(spec: dict, key: str) -> typing.Iterator[dict]:
+    """
+    Iterate over the entries of `key` in the spec and in nested group marks.
+    """
+    yield from spec.get(key, [])
+    for mark in spec.get("marks", []):
+        yield from _walk_named(mark, key)
+
+
 def _extract_used_data(transforms) -> typing.Set[str]:
     """
     Given a list of transforms, returns a set of the data fields they depend on.
@@ -173,7 +527,7 @@ def _retrieve_expr_key(name: str) -> typing.Optional[str]:
     if not name.startswith(DATA_NAME_PREFIX):
         return None
     key = name[len(DATA_NAME_PREFIX) :]
-    if key not in _expr_map:
+    if key not in expression_registry:
         raise ValueError(f"Unrecognized ibis data name {name}")
     return key
 
@@ -181,20 +535,71 @@ def _retrieve_expr_key(name: str) -> typing.Optional[str]:
 def _cleanup_spec(spec):
     """
     Goes through the spec and removes data sources that are not referenced
-    anywhere else in the spec. Does this by turning the spec into a string
-    and seeing if the name of the data is in the string.
+    anywhere else in the spec.
+
+    Does this by building an index of the data names each part of the spec
+    references, in a single traversal. Data which are only referenced by
+    removed data are removed as well.
     """
+    names = {data["name"] for data in spec["data"]}
+    data_references = [
+        _references(data, names) - {data["name"]} for data in spec["data"]
+    ]
+    counts = collections.Counter(
+        _references({k: v for k, v in spec.items() if k != "data"}, names)
+    )
+    for references in data_references:
+        counts.update(references)
 
-    nonreferenced_data = []
-    for data in spec["data"]:
-        name = data["name"]
-        # create a vesion of the spec where this data is removed
-        without_this_data = copy.deepcopy(spec)
-        without_this_data["data"].remove(data)
-        has_reference = name in str(without_this_data)
-        if not has_reference:
-            nonreferenced_data.append(data)
-
-    new = copy.deepcopy(spec)
-    new["data"] = [data for data in new["data"] if data not in nonreferenced_data]
+    by_name = {data["name"]: i for i, data in enumerate(spec["data"])}
+    removed: typing.Set[int] = set()
+    unreferenced = [name for name in by_name if not counts[name]]
+    while unreferenced:
+        i = by_name[unreferenced.pop()]
+        if i in removed:
+            continue
+        removed.add(i)
+        for name in data_references[i]:
+            counts[name] -= 1
+            if not counts[name]:
+                unreferenced.append(name)
+
+    new = dict(spec)
+    new["data"] = [data for i, data in enumerate(spec["data"]) if i not in removed]
     return new
+
+
+# Keys whose string values are names of data
+DATA_KEYS = {"data", "source", "from"}
+
+# Quoted strings in expressions, which can be data names
+_QUOTED = re.compile(r"""(["'])(.*?)\1""")
+
+
+def _references(value: typing.Any, names: typing.Set[str]) -> typing.Set[str]:
+    """
+    Returns the data names referenced in some part of a spec.
+
+    A data is referenced by a `data`, `source` or `from` property, or
+    by a quoted string in an expression, like `data("name")`.
+    """
+    references: typing.Set[str] = set()
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key in DATA_KEYS and isinstance(item, (str, list)):
+                    references.update(
+                        name
+                        for name in promote_list(item)
+                        if isinstance(name, str) and name in names
+                    )
+                stack.append(item)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            references.update(
+                m.group(2) for m in _QUOTED.finditer(value) if m.group(2) in names
+            )
+    return references
@@ -1,14 +1,27 @@
-from typing import Any
+import hashlib
+import json
+from typing import Any, Optional
 
 import ibis
 
 from . import transforms
+from .cache import expression_cache
+from .optimize import optimize
+from .params import current_params
+from .rollup import rewrite
 from .util import promote_list
+from .vegaexpr import Bindings
 
 __all__ = ["apply"]
 
 
-def apply(expr: ibis.Expr, transforms: Any) -> ibis.Expr:
+def apply(
+    expr: ibis.Expr,
+    transforms: Any,
+    name: Optional[str] = None,
+    bindings: Optional[Bindings] = None,
+    sample: Optional[float] = None,
+) -> ibis.Expr:
     """Apply transform or transforms to the expression.
 
     Parameters
@@ -18,6 +31,22 @@ def apply(expr: ibis.Expr, transforms: Any) -> ibis.Expr:
         A transform specification or list of transform specifications.
         Each specification must be valid according to Vega's transform
         schema.
+    name: Optional[str]
+        The key of the expression in the expression registry. If given, the expressions
+        built for each prefix of the transforms are memoized, so that only
+        the transforms after the first one that changed are applied again.
+    bindings: Optional[Bindings]
+        The data sets referenced by the expressions of the transforms, by name,
+        like the selections they test.
+    sample: Optional[float]
+        If given, the first aggregate only reads a random sample of about this
+        fraction of its input rows, and scales its counts and sums up to estimate
+        those of all rows. The transforms before it read all the rows, so bins
+        get the same extents as without sampling. Expressions are not memoized
+        then.
+
+    If a rollup of the expression `name` can answer the transforms, they are
+    applied to the rollup instead.
 
     Returns
     -------
@@ -26,7 +55,19 @@ def apply(expr: ibis.Expr, transforms: Any) -> ibis.Expr:
     """
     if transforms is None:
         return expr
+    bindings = bindings or {}
     transforms = promote_list(transforms)
+    if name is not None and sample is None:
+        rolled_up = rewrite(name, transforms, bindings)
+        if rolled_up is not None:
+            expr, transforms = rolled_up
+    transforms, columns = optimize(transforms, bindings)
+
+    # Only read the columns of the expression which the transforms use
+    if columns is not None:
+        used = [c for c in expr.columns if c in columns]
+        if used and len(used) < len(expr.columns):
+            expr = expr[used]
 
     # First traverse list of transforms, and find any that create bins
     # The resulting bin fields, we create as the source fields,
@@ -42,7 +83,7 @@ def apply(expr: ibis.Expr, transforms: Any) -> ibis.Expr:
     # Have extra processing for extents that create signals
     # can probably remove once https://github.com/vega/vega-lite/issues/5320 is fixed.
     signal_mapping = {}
-
+    resolved = []
     for t in transforms:
         if t["type"] == "extent":
             assert {"field", "signal_", "type"} == t.keys()
@@ -51,11 +92,85 @@ def apply(expr: ibis.Expr, transforms: Any) -> ibis.Expr:
         # Change binning that reference  signal extent with actual value
         if "extent" in t and "signal" in t["extent"]:
             t["extent"] = signal_mapping.pop(t["extent"]["signal"])
-        expr = _delegate_transform(t, expr)
+        resolved.append(t)
+
+    if sample is not None:
+        sampled = False
+        for t in resolved:
+            if t["type"] == "aggregate" and not sampled:
+                sampled = True
+                expr = expr[ibis.random() < sample]
+                expr = _delegate_transform(t, expr, bindings, 1 / sample)
+            else:
+                expr = _delegate_transform(t, expr, bindings)
+        return expr
+
+    if name is None:
+        for t in resolved:
+            expr = _delegate_transform(t, expr, bindings)
+        return expr
+
+    # The expression we start from depends on the columns we kept
+    # and the bins we added, so start the hash of the prefixes with them
+    prefix_hash = hashlib.sha1(json.dumps(expr.columns).encode())
+    keys = []
+    parametrized = False
+    for t in resolved:
+        prefix_hash.update(json.dumps(t, sort_keys=True, default=str).encode())
+        # The expressions of the transform may also depend on bound data,
+        # where selected values are parameters, named after their position
+        bound = _used_bindings(t, bindings)
+        if bound:
+            parametrized = True
+            prefix_hash.update(_dumps(bound).encode())
+        # Bins query their extent while they are built, which depends on
+        # the values of the parameters before them
+        if parametrized and t["type"] == "bin":
+            values = {p.get_name(): v for p, v in current_params().items()}
+            prefix_hash.update(_dumps(values).encode())
+        keys.append((name, prefix_hash.hexdigest()))
+
+    # Start from the longest prefix we already built
+    start = 0
+    for i in reversed(range(len(keys))):
+        cached = expression_cache.get(keys[i])
+        if cached is not None:
+            expr, start = cached, i + 1
+            break
+    for t, key in zip(resolved[start:], keys[start:]):
+        expr = _delegate_transform(t, expr, bindings)
+        expression_cache.put(key, expr, 1)
     return expr
 
 
-def _delegate_transform(transform: dict, expr: ibis.Expr) -> ibis.Expr:
+def _dumps(value: Any) -> str:
+    return json.dumps(
+        value,
+        sort_keys=True,
+        default=lambda v: v.get_name() if isinstance(v, ibis.Expr) else str(v),
+    )
+
+
+def _used_bindings(transform: dict, bindings: Bindings) -> Bindings:
+    """
+    The bound data sets whose name appears as a string in the expression
+    of the transform.
+    """
+    if "expr" not in transform:
+        return {}
+    return {
+        name: values
+        for name, values in bindings.items()
+        if f'"{name}"' in transform["expr"] or f"'{name}'" in transform["expr"]
+    }
+
+
+def _delegate_transform(
+    transform: dict,
+    expr: ibis.Expr,
+    bindings: Optional[Bindings] = None,
+    scale: float = 1.0,
+) -> ibis.Expr:
     """
     Apply a vega transform to an ibis expression.
 
@@ -70,6 +185,10 @@ def _delegate_transform(transform: dict, expr: ibis.Expr) -> ibis.Expr:
         A JSON-able representation of a vega transform.
     expr: ibis.Expr
         An expression to transform.
+    bindings: Optional[Bindings]
+        The data sets referenced by vega expressions, by name.
+    scale: float
+        The factor to scale counts and sums of aggregates by.
 
     Returns
     -------
@@ -77,6 +196,10 @@ def _delegate_transform(transform: dict, expr: ibis.Expr) -> ibis.Expr:
     """
     t = getattr(transforms, transform["type"])
     if t is not None:
+        if transform["type"] in ("filter", "formula"):
+            return t(transform, expr, bindings)
+        if transform["type"] == "aggregate":
+            return t(transform, expr, scale)
         return t(transform, expr)
     else:
         raise NotImplementedError(f"Transform of type {t} is not implemented")
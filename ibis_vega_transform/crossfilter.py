@@ -0,0 +1,293 @@
+"""
+Crossfilter indexes, which answer histograms filtered by a brush on another
+field from counts precomputed in the kernel, like Falcon
+(https://github.com/uwdata/falcon).
+
+For each histogram, the rows are counted once per bin of the histogram and
+bucket of the brushed field, and the counts are summed over the buckets, so
+the histogram for any brush is the difference of two rows of sums.
+"""
+import collections
+import json
+import re
+import threading
+import typing
+
+import ibis
+import ibis.expr.types as it
+import numpy
+import pandas
+
+from .core import apply
+from .globals import get_crossfilter_resolution
+from .pool import execute_pooled
+from .tracer import tracer
+from .util import promote_list
+from .vegaexpr import Bindings
+
+__all__ = ["CrossfilterIndex", "crossfilter_query", "drop_indexes"]
+
+# Number of indexes to keep, one for each histogram and brushed field
+MAX_INDEXES = 16
+
+# Transforms which may come before the aggregate, besides the brush filter.
+# Other filters commute with it.
+PREFIX_TYPES = {"extent", "bin", "filter", "formula"}
+
+BUCKET = "__crossfilter_bucket"
+COUNT = "__crossfilter_count"
+
+
+class CrossfilterIndex:
+    """
+    Counts of the rows in each bin of a histogram, summed over the buckets
+    of the brushed field.
+    """
+
+    def __init__(
+        self,
+        min_: float,
+        max_: float,
+        resolution: int,
+        bins: pandas.DataFrame,
+        counts: numpy.ndarray,
+    ):
+        self.min = min_
+        self.max = max_
+        self.resolution = resolution
+        # The left and right edges of each bin of the histogram
+        self.bins = bins
+        # `sums[i, j]` is the number of rows in bin `j` and buckets before `i`
+        self.sums = numpy.vstack(
+            [numpy.zeros((1, counts.shape[1]), dtype="int64"), counts.cumsum(axis=0)]
+        )
+
+    def query(self, lower: float, upper: float, count: str) -> pandas.DataFrame:
+        """
+        The histogram of the rows whose brushed field is between the bounds,
+        which are rounded to the buckets they fall in.
+        """
+        lower, upper = sorted([lower, upper])
+        if upper < self.min or lower > self.max:
+            counts = numpy.zeros(len(self.bins), dtype="int64")
+        else:
+            first, last = self._bucket(lower), self._bucket(upper)
+            counts = self.sums[last + 1] - self.sums[first]
+        result = self.bins.assign(**{count: counts})
+        return result[counts > 0].reset_index(drop=True)
+
+    def _bucket(self, value: float) -> int:
+        if self.max == self.min:
+            return 0
+        bucket = int((value - self.min) * self.resolution / (self.max - self.min))
+        return min(max(bucket, 0), self.resolution - 1)
+
+
+_indexes: "collections.OrderedDict[tuple, CrossfilterIndex]" = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+# Indexes being built, so concurrent queries wait for the same one
+_building: typing.Dict[tuple, threading.Lock] = {}
+
+
+def crossfilter_query(
+    expr: ibis.Expr, name: str, transforms: typing.List[dict], bindings: Bindings
+) -> typing.Optional[pandas.DataFrame]:
+    """
+    Answer a histogram filtered by a brush from its crossfilter index, building
+    the index if needed.
+
+    Returns None if crossfilter indexes are disabled, or the transforms are not
+    a histogram filtered by a non empty brush on a numeric field.
+    """
+    resolution = get_crossfilter_resolution()
+    if resolution is None:
+        return None
+    match = _match(transforms, bindings)
+    if match is None:
+        return None
+    prefix, aggregate, field, (lower, upper) = match
+    if field not in expr.columns or not isinstance(expr[field], it.NumericValue):
+        return None
+    # Other selections the transforms filter on are part of the index
+    used = {
+        n: v
+        for n, v in bindings.items()
+        if any(f'"{n}"' in t.get("expr", "") for t in prefix)
+    }
+    key = (
+        name,
+        json.dumps([prefix, aggregate, used], sort_keys=True, default=str),
+        field,
+        resolution,
+    )
+    index = _get_index(key, expr, prefix, aggregate, field, resolution, used)
+    if index is None:
+        return None
+    return index.query(lower, upper, aggregate["as"][0])
+
+
+def drop_indexes(name: typing.Optional[str] = None) -> None:
+    """
+    Drop the indexes of the expression `name`, or all of them if no name is
+    given, for instance after the underlying table changed.
+    """
+    with _indexes_lock:
+        for key in [k for k in _indexes if name is None or k[0] == name]:
+            del _indexes[key]
+
+
+def _match(
+    transforms: typing.List[dict], bindings: Bindings
+) -> typing.Optional[tuple]:
+    """
+    Match transforms which bin a field, filter on a brush and count the rows in
+    each bin. Bins must come before the brush filter, so they don't depend on it.
+
+    Returns the transforms without the brush filter and the aggregate, the
+    aggregate, the brushed field and the bounds of the brush.
+    """
+    if not transforms:
+        return None
+    *before, aggregate = transforms
+    bins = [t for t in before if t["type"] == "bin"]
+    if (
+        aggregate["type"] != "aggregate"
+        or aggregate.get("ops", ["count"]) != ["count"]
+        or aggregate.get("fields", [None]) != [None]
+        or "as" not in aggregate
+        or len(bins) != 1
+        or list(aggregate["groupby"]) != list(bins[0]["as"])
+        or any(t["type"] not in PREFIX_TYPES for t in before)
+    ):
+        return None
+    brushes = [
+        i
+        for i, t in enumerate(before)
+        if t["type"] == "filter" and _brush_store(t["expr"])
+    ]
+    if len(brushes) != 1 or before.index(bins[0]) > brushes[0]:
+        return None
+    (brush,) = brushes
+    entries = bindings.get(_brush_store(before[brush]["expr"]) or "")
+    if (
+        not entries
+        or len(entries) != 1
+        or len(entries[0]["fields"]) != 1
+        or len(entries[0]["values"]) != 1
+    ):
+        return None
+    (brushed,), (bounds,) = entries[0]["fields"], entries[0]["values"]
+    if (
+        brushed["type"] != "R"
+        or not isinstance(bounds, list)
+        or len(bounds) != 2
+        or any(isinstance(v, bool) or not isinstance(v, (int, float)) for v in bounds)
+    ):
+        return None
+    # The brush must test the field of the table, not a computed one
+    for t in before:
+        if brushed["field"] in promote_list(t.get("as", [])):
+            return None
+    prefix = before[:brush] + before[brush + 1 :]
+    return prefix, aggregate, brushed["field"], tuple(bounds)
+
+
+# The filter vega-lite generates for a selection, which keeps everything
+# while the selection is empty
+_BRUSH_FILTER = re.compile(
+    r"""!\(?length\(data\((["'])(.+?)\1\)\)\)?\s*\|\|\s*"""
+    r"""\(?vlSelectionTest\(\1\2\1,\s*datum\)\)?"""
+)
+
+
+def _brush_store(expr: str) -> typing.Optional[str]:
+    match = _BRUSH_FILTER.fullmatch(expr.strip())
+    return match.group(2) if match else None
+
+
+def _get_index(
+    key: tuple,
+    expr: ibis.Expr,
+    prefix: typing.List[dict],
+    aggregate: dict,
+    field: str,
+    resolution: int,
+    bindings: Bindings,
+) -> typing.Optional[CrossfilterIndex]:
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+        lock = _building.setdefault(key, threading.Lock())
+    with lock:
+        with _indexes_lock:
+            if key in _indexes:
+                return _indexes[key]
+        try:
+            index = _build(expr, prefix, aggregate, field, resolution, bindings)
+        finally:
+            with _indexes_lock:
+                _building.pop(key, None)
+        if index is None:
+            return None
+        with _indexes_lock:
+            _indexes[key] = index
+            while len(_indexes) > MAX_INDEXES:
+                _indexes.popitem(last=False)
+    return index
+
+
+def _build(
+    expr: ibis.Expr,
+    prefix: typing.List[dict],
+    aggregate: dict,
+    field: str,
+    resolution: int,
+    bindings: Bindings,
+) -> typing.Optional[CrossfilterIndex]:
+    """
+    Count the rows by bin of the histogram and bucket of the brushed field.
+    """
+    with tracer.start_span("crossfilter:build") as span:
+        column = expr[field]
+        extent = expr.aggregate([column.min().name("min"), column.max().name("max")])
+        (row,) = execute_pooled(extent).to_dict("records")
+        if row["min"] is None or pandas.isnull(row["min"]):
+            return None
+        min_, max_ = float(row["min"]), float(row["max"])
+        if max_ == min_:
+            bucket = ibis.case().when(column.notnull(), 0).end()
+        else:
+            bucket = ((column - min_) * (resolution / (max_ - min_))).floor()
+            bucket = (bucket >= resolution).ifelse(resolution - 1, bucket)
+        left, right = aggregate["groupby"]
+        # Bin all the rows, so extents computed by the transforms are the
+        # same as in the exact query
+        count_expr = apply(
+            expr.mutate(bucket.name(BUCKET)),
+            prefix
+            + [
+                {
+                    "type": "aggregate",
+                    "groupby": [left, right, BUCKET],
+                    "ops": ["count"],
+                    "fields": [None],
+                    "as": [COUNT],
+                }
+            ],
+            bindings=bindings,
+        )
+        span.log_kv({"sql": count_expr.compile()})
+        data = execute_pooled(count_expr)
+    # Brushes never select missing values
+    data = data[data[BUCKET].notnull()]
+    # Number the bins in order, keeping the bin of missing values
+    groups = data.groupby([left, right], dropna=False, sort=True)
+    bins = groups.size().index.to_frame(index=False)
+    counts = numpy.zeros((resolution, len(bins)), dtype="int64")
+    numpy.add.at(
+        counts,
+        (data[BUCKET].to_numpy(dtype="int64"), groups.ngroup().to_numpy()),
+        data[COUNT].to_numpy(dtype="int64"),
+    )
+    return CrossfilterIndex(min_, max_, resolution, bins, counts)
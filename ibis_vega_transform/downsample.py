@@ -0,0 +1,166 @@
+"""
+Downsampling of query results for line and symbol marks, so the size of
+the result is bounded by the size of the chart instead of the size of the table.
+"""
+import functools
+import operator
+import typing
+
+import ibis
+import ibis.expr.types as it
+from mypy_extensions import TypedDict
+from typing_extensions import Literal
+
+from .cache import extent_cache
+from .params import current_params
+from .pool import execute_pooled
+from .tracer import tracer
+
+__all__ = ["DownsampleSpec", "downsample"]
+
+DownsampleSpec = TypedDict(
+    "DownsampleSpec",
+    {
+        # The type of mark the data is drawn with
+        "mark": Literal["line", "symbol"],
+        # The fields encoded on the x and y channels
+        "x": str,
+        "y": str,
+        # Other fields which change how the mark is drawn, like the series
+        # of a line or the color of a point
+        "groupby": typing.List[str],
+        # The size of the chart in pixels
+        "width": int,
+        "height": int,
+    },
+)
+
+BUCKET = "__bucket"
+X_BUCKET = "__x_bucket"
+Y_BUCKET = "__y_bucket"
+X = "__x"
+Y = "__y"
+RANK = "__rank"
+
+
+def downsample(expr: ibis.Expr, spec: DownsampleSpec) -> ibis.Expr:
+    """
+    Downsample the result of an expression to the pixels of the chart.
+
+    Lines are downsampled with M4: for each pixel column and series, only the rows
+    with the first and last x value and the min and max y value are kept,
+    which draws the same line.
+    Symbols are downsampled to one row per pixel and combination of other encoded
+    fields, which draws the same points if they are opaque.
+
+    Both keep whole rows of the expression, so fields which aren't encoded
+    visually, like tooltips, are still there.
+    """
+    x_num = _as_number(expr[spec["x"]])
+    y_num = _as_number(expr[spec["y"]])
+    extent = _extent(expr, x_num, y_num)
+    # Nothing to downsample if there are no non null values
+    if extent["x_min"] is None or extent["y_min"] is None:
+        return expr
+    x_bucket = _bucket(x_num, extent["x_min"], extent["x_max"], spec["width"])
+    if spec["mark"] == "line":
+        return _m4(expr, spec, x_bucket, x_num, y_num)
+    y_bucket = _bucket(y_num, extent["y_min"], extent["y_max"], spec["height"])
+    return _grid(expr, spec, x_bucket, y_bucket, x_num, y_num)
+
+
+def _extent(
+    expr: ibis.Expr, x_num: ibis.Expr, y_num: ibis.Expr
+) -> typing.Dict[str, typing.Any]:
+    """
+    The minimum and maximum of the x and y values, cached by the SQL of their query.
+    """
+    extent_expr = expr.aggregate(
+        [
+            x_num.min().name("x_min"),
+            x_num.max().name("x_max"),
+            y_num.min().name("y_min"),
+            y_num.max().name("y_max"),
+        ]
+    )
+    sql = extent_expr.compile(params=current_params())
+    key = ("downsample:extent", sql)
+    cached = extent_cache.get(key)
+    if cached is not None:
+        return cached
+    with tracer.start_span("downsample:extent") as span:
+        span.log_kv({"sql": sql})
+        (extent,) = execute_pooled(extent_expr).to_dict("records")
+    extent_cache.put(key, extent, len(sql))
+    return extent
+
+
+def _m4(
+    expr: ibis.Expr,
+    spec: DownsampleSpec,
+    x_bucket: ibis.Expr,
+    x_num: ibis.Expr,
+    y_num: ibis.Expr,
+) -> ibis.Expr:
+    """
+    Keep one row for each of the first and last x value and the min and max y
+    value of each pixel column and series, so ties don't add rows.
+    """
+    with_bucket = expr.mutate([x_bucket.name(BUCKET), x_num.name(X), y_num.name(Y)])
+    # Rank over windows instead of joining an aggregation back, so series
+    # whose group values are null are kept, as a partition of their own
+    group_by = [BUCKET] + spec["groupby"]
+    orders = [[X, Y], [ibis.desc(X), Y], [Y, X], [ibis.desc(Y), X]]
+    ranks = [f"{RANK}_{i}" for i in range(len(orders))]
+    ranked = with_bucket.mutate(
+        [
+            ibis.row_number().over(ibis.window(group_by=group_by, order_by=order))
+            .name(rank)
+            for order, rank in zip(orders, ranks)
+        ]
+    )
+    # Row numbers start at 0 in ibis
+    keep = functools.reduce(operator.or_, (ranked[rank] == 0 for rank in ranks))
+    return ranked[keep][expr.columns].sort_by(spec["x"])
+
+
+def _grid(
+    expr: ibis.Expr,
+    spec: DownsampleSpec,
+    x_bucket: ibis.Expr,
+    y_bucket: ibis.Expr,
+    x_num: ibis.Expr,
+    y_num: ibis.Expr,
+) -> ibis.Expr:
+    """
+    Keep the first row of each cell, by x and then y, so the points drawn
+    are rows of the expression.
+    """
+    with_bucket = expr.mutate(
+        [x_bucket.name(X_BUCKET), y_bucket.name(Y_BUCKET), x_num.name(X), y_num.name(Y)]
+    )
+    window = ibis.window(
+        group_by=[X_BUCKET, Y_BUCKET] + spec["groupby"], order_by=[X, Y]
+    )
+    ranked = with_bucket.mutate(ibis.row_number().over(window).name(RANK))
+    # Row numbers start at 0 in ibis
+    return ranked[ranked[RANK] == 0][expr.columns]
+
+
+def _bucket(value: ibis.Expr, min_, max_, pixels: int) -> ibis.Expr:
+    """
+    The index of the pixel a value falls in, from 0 to `pixels - 1`.
+    """
+    span = max_ - min_
+    if not span:
+        return ibis.literal(0)
+    bucket = ((value - min_) * (pixels / span)).floor()
+    return (bucket >= pixels).ifelse(pixels - 1, bucket)
+
+
+def _as_number(column: ibis.Expr) -> ibis.Expr:
+    if isinstance(column, it.DateValue):
+        column = column.cast("timestamp")
+    if isinstance(column, it.TimestampValue):
+        return column.epoch_seconds()
+    return column.cast("double")
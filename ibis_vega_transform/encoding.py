@@ -0,0 +1,86 @@
+"""
+Encoding of query results before they are sent to the frontend.
+"""
+import datetime
+import typing
+
+import altair
+import numpy
+import pandas
+import pandas.api.types as ptypes
+
+__all__ = ["Buffers", "encode_result"]
+
+Buffers = typing.List[memoryview]
+
+
+def encode_result(
+    data: pandas.DataFrame, encoding: str = "json"
+) -> typing.Tuple[typing.Any, Buffers]:
+    """
+    Encode a query result into the content of a comm message and its binary buffers.
+
+    Parameters
+    ----------
+    data: pandas.DataFrame
+        The result of the query.
+    encoding: str
+        Either "json", for a list of records, or "columnar", for one entry per column,
+        with numeric columns sent as binary buffers.
+    """
+    if encoding == "json":
+        return altair.to_values(data)["values"], []
+    if encoding == "columnar":
+        return _encode_columnar(data)
+    raise ValueError(f"Unknown result encoding {encoding}")
+
+
+def _encode_columnar(data: pandas.DataFrame) -> typing.Tuple[dict, Buffers]:
+    """
+    Encode the columns of the dataframe separately.
+
+    Boolean and numeric columns become little endian uint8/float64 buffers, where
+    NaN marks a missing number. Dates become ISO strings, parsed by the frontend,
+    and the remaining columns become JSON lists.
+    """
+    columns = []
+    buffers: Buffers = []
+    for name in data.columns:
+        series = data[name]
+        column: typing.Dict[str, typing.Any] = {"name": str(name)}
+        if ptypes.is_bool_dtype(series) and not series.hasnans:
+            column["type"] = "boolean"
+            column["buffer"] = len(buffers)
+            buffers.append(memoryview(series.to_numpy(dtype="u1")))
+        elif ptypes.is_numeric_dtype(series) and not ptypes.is_bool_dtype(series):
+            column["type"] = "number"
+            column["buffer"] = len(buffers)
+            values = series.to_numpy(dtype="<f8", na_value=numpy.nan)
+            buffers.append(memoryview(numpy.ascontiguousarray(values)))
+        elif ptypes.is_datetime64_any_dtype(series):
+            column["type"] = "date"
+            column["values"] = [
+                None if pandas.isnull(v) else v.isoformat() for v in series
+            ]
+        else:
+            column["type"] = "date" if _is_date_column(series) else "json"
+            column["values"] = [_to_json(v) for v in series]
+        columns.append(column)
+    return {"format": "columnar", "length": len(data), "columns": columns}, buffers
+
+
+def _is_date_column(series: pandas.Series) -> bool:
+    non_null = series.dropna()
+    return len(non_null) > 0 and all(
+        isinstance(v, (datetime.date, datetime.datetime)) for v in non_null
+    )
+
+
+def _to_json(value: typing.Any) -> typing.Any:
+    if value is None or (not isinstance(value, (list, dict)) and pandas.isnull(value)):
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
@@ -0,0 +1,63 @@
+"""
+Samples of the rows of an expression, which the fallback renders with the
+default Altair pipeline instead of querying the database lazily.
+"""
+import typing
+
+import ibis
+import pandas
+
+from .globals import get_fallback_sample
+from .pool import execute_pooled
+from .tracer import tracer
+
+__all__ = ["fallback_data"]
+
+# Stratifying by a column with more values than this samples uniformly instead,
+# since each value would only get a few rows
+MAX_STRATA = 1000
+
+
+def fallback_data(expr: ibis.Expr) -> pandas.DataFrame:
+    """
+    The rows of the expression if there are at most as many as the row budget,
+    or else a random sample of about that many rows.
+
+    The sample is uniform, unless a column to stratify by is set. Then each
+    value of the column gets the same share of the budget, and all of its rows
+    if it has fewer.
+    """
+    rows, stratify = get_fallback_sample()
+    with tracer.start_span("fallback:sample") as span:
+        total = execute_pooled(expr.count())
+        span.log_kv({"rows": total, "budget": rows})
+        if total <= rows:
+            return execute_pooled(expr)
+        fraction: typing.Any = rows / total
+        if stratify is not None and stratify in expr.columns:
+            fraction = _stratified_fraction(expr, stratify, rows, fraction)
+        sample = expr[ibis.random() < fraction].limit(rows)
+        span.log_kv({"sql": sample.compile()})
+        return execute_pooled(sample)
+
+
+def _stratified_fraction(
+    expr: ibis.Expr, column: str, rows: int, default: float
+) -> typing.Any:
+    """
+    An expression for the fraction of the rows to keep, depending on the value
+    of the column. Values we don't know the count of keep the default fraction.
+    """
+    counts = execute_pooled(
+        expr.group_by(column).aggregate(expr.count().name("count"))
+    )
+    counts = counts[counts[column].notnull()]
+    if counts.empty or len(counts) > MAX_STRATA:
+        return default
+    share = rows / len(counts)
+    case = expr[column].case()
+    for value, count in zip(counts[column], counts["count"]):
+        # Unwrap numpy scalars, which ibis can't make literals of
+        value = value.item() if hasattr(value, "item") else value
+        case = case.when(value, min(1.0, share / count))
+    return case.else_(default).end()
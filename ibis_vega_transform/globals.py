@@ -1,15 +1,33 @@
 import typing
+import uuid
 from IPython.core.display import JSON
-import ibis
 from numpy.lib.function_base import disp
 import opentracing
 import IPython.display
 
 __all__ = [
-    "_expr_map",
     "DATA_NAME_PREFIX",
+    "SESSION_ID",
     "get_fallback",
     "set_fallback",
+    "get_fallback_sample",
+    "set_fallback_sample",
+    "get_result_encoding",
+    "set_result_encoding",
+    "get_stream_batch_size",
+    "set_stream_batch_size",
+    "get_downsampling",
+    "set_downsampling",
+    "get_prefetch",
+    "set_prefetch",
+    "get_selection_table_threshold",
+    "set_selection_table_threshold",
+    "get_preview_sample",
+    "set_preview_sample",
+    "get_rollups",
+    "set_rollups",
+    "get_crossfilter_resolution",
+    "set_crossfilter_resolution",
     "get_active_span",
     "set_active_span",
     "enable_debug",
@@ -19,10 +37,12 @@ __all__ = [
 ]
 
 
-_expr_map: typing.Dict[str, ibis.Expr] = {}
-
 DATA_NAME_PREFIX = "ibis:"
 
+# Part of the names of the tables this kernel creates in the database, so
+# kernels sharing a database never touch each other's tables
+SESSION_ID = uuid.uuid4().hex[:12]
+
 
 # Whether to fallback to getting the dataset as a pandas dataframe
 # and rendering it manually, that way.
@@ -38,6 +58,141 @@ def get_fallback() -> bool:
     return FALLBACK
 
 
+# Number of rows the fallback pulls into the dataframe it renders, and the column
+# to stratify the sample by, so rare values of it are represented too.
+FALLBACK_ROWS = 5000
+FALLBACK_STRATIFY: typing.Optional[str] = None
+
+
+def set_fallback_sample(rows: int, stratify: typing.Optional[str] = None) -> None:
+    if rows < 1:
+        raise ValueError(f"The fallback sample must have at least one row, not {rows}")
+    global FALLBACK_ROWS, FALLBACK_STRATIFY
+    FALLBACK_ROWS = rows
+    FALLBACK_STRATIFY = stratify
+
+
+def get_fallback_sample() -> typing.Tuple[int, typing.Optional[str]]:
+    return FALLBACK_ROWS, FALLBACK_STRATIFY
+
+
+# How query results are sent to the frontend, either as a list of records ("json")
+# or as typed columns in binary buffers ("columnar"), if the frontend supports it.
+RESULT_ENCODING = "columnar"
+
+
+def set_result_encoding(encoding: str) -> None:
+    global RESULT_ENCODING
+    if encoding not in ("json", "columnar"):
+        raise ValueError(f"Unknown result encoding {encoding}")
+    RESULT_ENCODING = encoding
+
+
+def get_result_encoding() -> str:
+    return RESULT_ENCODING
+
+
+# If set, query results are streamed to the frontend in batches of this many rows,
+# so the chart can be drawn before the whole result has been fetched.
+STREAM_BATCH_SIZE: typing.Optional[int] = None
+
+
+def set_stream_batch_size(batch_size: typing.Optional[int]) -> None:
+    global STREAM_BATCH_SIZE
+    if batch_size is not None and batch_size < 1:
+        raise ValueError(f"Batch size must be positive, not {batch_size}")
+    STREAM_BATCH_SIZE = batch_size
+
+
+def get_stream_batch_size() -> typing.Optional[int]:
+    return STREAM_BATCH_SIZE
+
+
+# Whether to downsample the data of line and symbol marks to the pixels of the chart.
+DOWNSAMPLING = False
+
+
+def set_downsampling(downsampling: bool) -> None:
+    global DOWNSAMPLING
+    DOWNSAMPLING = downsampling
+
+
+def get_downsampling() -> bool:
+    return DOWNSAMPLING
+
+
+# Whether to start executing the initial queries of a chart while it is compiled.
+# Off by default, since the frontend may never request them.
+PREFETCH = False
+
+
+def set_prefetch(prefetch: bool) -> None:
+    global PREFETCH
+    PREFETCH = prefetch
+
+
+def get_prefetch() -> bool:
+    return PREFETCH
+
+
+# Number of selected points above which they are uploaded to a table
+# which is joined, instead of being listed in the query. None disables it,
+# which is the default since it needs permission to create tables.
+SELECTION_TABLE_THRESHOLD: typing.Optional[int] = None
+
+
+def set_selection_table_threshold(threshold: typing.Optional[int]) -> None:
+    global SELECTION_TABLE_THRESHOLD
+    SELECTION_TABLE_THRESHOLD = threshold
+
+
+def get_selection_table_threshold() -> typing.Optional[int]:
+    return SELECTION_TABLE_THRESHOLD
+
+
+# Fraction of rows to aggregate for a preview, sent before the exact result
+# of aggregate queries. None disables previews.
+PREVIEW_SAMPLE: typing.Optional[float] = None
+
+
+def set_preview_sample(fraction: typing.Optional[float]) -> None:
+    if fraction is not None and not 0 < fraction < 1:
+        raise ValueError(f"The preview sample must be between 0 and 1, not {fraction}")
+    global PREVIEW_SAMPLE
+    PREVIEW_SAMPLE = fraction
+
+
+def get_preview_sample() -> typing.Optional[float]:
+    return PREVIEW_SAMPLE
+
+
+# Whether to build rollup tables for the aggregations of compiled charts
+ROLLUPS = False
+
+
+def set_rollups(rollups: bool) -> None:
+    global ROLLUPS
+    ROLLUPS = rollups
+
+
+def get_rollups() -> bool:
+    return ROLLUPS
+
+
+# Number of buckets brushed fields are split into by crossfilter indexes,
+# which answer histograms filtered by a brush. None disables them.
+CROSSFILTER_RESOLUTION: typing.Optional[int] = None
+
+
+def set_crossfilter_resolution(resolution: typing.Optional[int]) -> None:
+    global CROSSFILTER_RESOLUTION
+    CROSSFILTER_RESOLUTION = resolution
+
+
+def get_crossfilter_resolution() -> typing.Optional[int]:
+    return CROSSFILTER_RESOLUTION
+
+
 active_span: typing.Optional[opentracing.Span] = None
 
 
@@ -57,9 +212,14 @@ JSON_DISPLAY = None
 
 
 def reset_debug():
+    """
+    Start a new debug display for the next chart. It is only created once
+    something is logged to it, so charts built without debugging don't
+    display anything.
+    """
     global JSON_DISPLAY, DISPLAY
-    JSON_DISPLAY = IPython.display.JSON({}, root="ibis_vega_transform")
-    DISPLAY = IPython.display.display(JSON_DISPLAY, display_id=True)
+    JSON_DISPLAY = None
+    DISPLAY = None
 
 
 def enable_debug():
@@ -73,6 +233,10 @@ def disable_debug():
 
 
 def debug(key: str, value):
+    global JSON_DISPLAY, DISPLAY
     if DEBUG:
+        if JSON_DISPLAY is None:
+            JSON_DISPLAY = IPython.display.JSON({}, root="ibis_vega_transform")
+            DISPLAY = IPython.display.display(JSON_DISPLAY, display_id=True)
         JSON_DISPLAY.data[key] = value
         DISPLAY.update(JSON_DISPLAY)
@@ -0,0 +1,179 @@
+"""
+Optimization of a list of vega transforms before it is translated into ibis,
+so the generated SQL is flatter and reads fewer columns.
+"""
+import re
+import typing
+
+from .util import promote_list
+from .vegaexpr import Bindings
+
+__all__ = ["optimize"]
+
+# Stands for "every column", when we can't tell which columns are used
+ALL = None
+
+Columns = typing.Optional[typing.Set[str]]
+
+_DATUM_FIELD = re.compile(
+    r"""\bdatum(?:\.([A-Za-z_$][\w$]*)|\[\s*(["'])(.*?)\2\s*\])"""
+)
+_DATUM = re.compile(r"\bdatum\b")
+# Selection tests of a named selection, on the whole datum
+_SELECTION_TEST = re.compile(
+    r"""\bvlSelectionTest\(\s*(["'])(.*?)\1\s*,\s*datum\s*[,)]"""
+)
+
+
+def optimize(
+    transforms: typing.List[dict], bindings: typing.Optional[Bindings] = None
+) -> typing.Tuple[typing.List[dict], Columns]:
+    """
+    Optimize a list of vega transforms, whose expressions reference the data sets
+    in `bindings`.
+
+    Filters are moved before formulas they don't depend on, adjacent filters are
+    merged into one, and formulas and bins whose output is never read are dropped.
+
+    Returns the new list of transforms, and the columns of the input they read,
+    or None if that can't be determined.
+    """
+    bindings = bindings or {}
+    transforms = [dict(t) for t in transforms]
+    transforms = _push_down_filters(transforms, bindings)
+    transforms = _merge_filters(transforms)
+    return _prune(transforms, bindings)
+
+
+def expression_fields(
+    expr: str, bindings: typing.Optional[Bindings] = None
+) -> Columns:
+    """
+    The fields of `datum` read by a vega expression, or None if it
+    uses `datum` in a way we can't follow, like passing it to a function.
+    """
+    matches = list(_DATUM_FIELD.finditer(expr))
+    fields = {match.group(1) or match.group(3) for match in matches}
+    bare = len(_DATUM.findall(expr)) - len(matches)
+    if not bare:
+        return fields
+    # `datum` may only be passed to tests of bound selections, which read
+    # the fields of the selection
+    tests = [match.group(2) for match in _SELECTION_TEST.finditer(expr)]
+    if bare != len(tests) or len(tests) != expr.count("vlSelectionTest("):
+        return ALL
+    for name in tests:
+        if bindings is None or name not in bindings:
+            return ALL
+        for entry in bindings[name]:
+            fields |= {field["field"] for field in entry["fields"]}
+    return fields
+
+
+def _push_down_filters(
+    transforms: typing.List[dict], bindings: Bindings
+) -> typing.List[dict]:
+    """
+    Move filters before the formulas that come before them, if they don't read
+    the field the formula computes.
+    """
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(transforms) - 1):
+            formula, filter_ = transforms[i], transforms[i + 1]
+            if formula["type"] != "formula" or filter_["type"] != "filter":
+                continue
+            fields = expression_fields(filter_["expr"], bindings)
+            if fields is ALL or formula["as"] in fields:
+                continue
+            transforms[i], transforms[i + 1] = filter_, formula
+            changed = True
+    return transforms
+
+
+def _merge_filters(transforms: typing.List[dict]) -> typing.List[dict]:
+    merged: typing.List[dict] = []
+    for t in transforms:
+        if t["type"] == "filter" and merged and merged[-1]["type"] == "filter":
+            merged[-1] = {
+                "type": "filter",
+                "expr": f"({merged[-1]['expr']}) && ({t['expr']})",
+            }
+        else:
+            merged.append(t)
+    return merged
+
+
+def _prune(
+    transforms: typing.List[dict], bindings: Bindings
+) -> typing.Tuple[typing.List[dict], Columns]:
+    """
+    Walk the transforms backwards, keeping track of the columns that are read
+    after each one, and drop the formulas and bins that compute unread columns.
+    """
+    # Bins are applied to a copy of their field at the start, so their output
+    # can be read by transforms which come before them
+    read_anywhere: Columns = set()
+    for t in transforms:
+        read_anywhere = _union(read_anywhere, _reads(t, bindings))
+
+    needed: Columns = ALL
+    kept: typing.List[dict] = []
+    for t in reversed(transforms):
+        outputs = _outputs(t)
+        if t["type"] in ("formula", "bin") and needed is not ALL:
+            unread = not outputs & needed
+            if t["type"] == "bin":
+                unread = unread and (
+                    read_anywhere is not ALL and not outputs & read_anywhere
+                )
+            if unread:
+                continue
+        kept.append(t)
+        if t["type"] == "aggregate":
+            needed = set()
+        elif needed is not ALL:
+            needed = needed - outputs
+        needed = _union(needed, _reads(t, bindings))
+    kept.reverse()
+    return kept, needed
+
+
+def _reads(t: dict, bindings: Bindings) -> Columns:
+    """
+    The columns a transform reads, or None if it could read any of them.
+    """
+    type_ = t["type"]
+    if type_ in ("filter", "formula"):
+        return expression_fields(t["expr"], bindings)
+    if type_ == "aggregate":
+        aggregated = {f for f in t.get("fields", []) if f}
+        return set(promote_list(t.get("groupby", []))) | aggregated
+    if type_ == "bin":
+        binned = {t["field"]}
+        if isinstance(t.get("extent"), str):
+            binned.add(t["extent"])
+        return binned
+    if type_ in ("extent", "timeunit"):
+        return {t["field"]}
+    if type_ == "collect":
+        return set(promote_list(t["sort"]["field"]))
+    if type_ == "project" and t.get("fields"):
+        return set(promote_list(t["fields"]))
+    return ALL
+
+
+def _outputs(t: dict) -> typing.Set[str]:
+    type_ = t["type"]
+    if type_ == "formula":
+        return {t["as"]}
+    if type_ in ("bin", "timeunit"):
+        return set(t["as"])
+    return set()
+
+
+def _union(a: Columns, b: Columns) -> Columns:
+    if a is ALL or b is ALL:
+        return ALL
+    return a | b
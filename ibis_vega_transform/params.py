@@ -0,0 +1,113 @@
+"""
+Query parameters for the values of selections, so the expressions built for a
+chart keep the same shape while the user interacts with it, and only the values
+bound to the parameters change.
+"""
+import contextlib
+import datetime
+import threading
+import typing
+
+import ibis
+
+from .vegaexpr import JS_DATETIME_FORMAT, Bindings, point_values
+
+__all__ = ["ParamValues", "parametrize", "use_params", "current_params"]
+
+# The values of the parameters of an expression, to pass when it is executed
+ParamValues = typing.Dict[ibis.Expr, typing.Any]
+
+# Parameters by key and type, so the same selection value always gets the same one
+_params: typing.Dict[typing.Tuple[str, str], ibis.Expr] = {}
+_params_lock = threading.Lock()
+
+
+def parametrize(bindings: Bindings) -> typing.Tuple[Bindings, ParamValues]:
+    """
+    Replace the values of the selections in the bindings by parameters.
+
+    Returns the bindings with parameters, which only depend on the number and
+    types of the selected values, and the values of the parameters.
+
+    Large lists of points are kept as they are, since they are uploaded to a table.
+    """
+    template: Bindings = {}
+    values: ParamValues = {}
+    for name, entries in bindings.items():
+        if not _is_selection(entries) or point_values(entries):
+            template[name] = entries
+            continue
+        template[name] = [
+            {
+                **entry,
+                "values": [
+                    _bind(f"{name}:{i}:{j}", value, values)
+                    for j, value in enumerate(entry["values"])
+                ],
+            }
+            for i, entry in enumerate(entries)
+        ]
+    return template, values
+
+
+def _is_selection(entries: typing.Any) -> bool:
+    return isinstance(entries, list) and all(
+        isinstance(entry, dict) and {"fields", "values"} <= entry.keys()
+        for entry in entries
+    )
+
+
+def _bind(key: str, value: typing.Any, values: ParamValues) -> typing.Any:
+    """
+    The parameter for a selected value, or for each value in a list of them.
+
+    Values we can't type, like nulls, are kept as literals.
+    """
+    if isinstance(value, list):
+        return [_bind(f"{key}:{k}", v, values) for k, v in enumerate(value)]
+    if isinstance(value, bool):
+        dtype = "boolean"
+    elif isinstance(value, (int, float)):
+        dtype = "double"
+    elif isinstance(value, datetime.datetime):
+        dtype = "timestamp"
+    elif isinstance(value, str):
+        # Dates in selections are serialized to JSON as ISO strings
+        try:
+            value = datetime.datetime.strptime(value, JS_DATETIME_FORMAT)
+            dtype = "timestamp"
+        except ValueError:
+            dtype = "string"
+    else:
+        return value
+    param = _param(key, dtype)
+    values[param] = value
+    return param
+
+
+def _param(key: str, dtype: str) -> ibis.Expr:
+    with _params_lock:
+        if (key, dtype) not in _params:
+            _params[key, dtype] = ibis.param(dtype).name(f"{key}:{dtype}")
+        return _params[key, dtype]
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def use_params(values: ParamValues) -> typing.Iterator[ParamValues]:
+    """
+    Bind the parameter values for the expressions compiled and executed
+    by this thread within the `with` block.
+    """
+    previous = current_params()
+    _local.params = values
+    try:
+        yield values
+    finally:
+        _local.params = previous
+
+
+def current_params() -> ParamValues:
+    return getattr(_local, "params", None) or {}
@@ -0,0 +1,413 @@
+"""
+Pool of reusable OmniSci connections, so queries can be executed concurrently
+without creating a new client for every query.
+"""
+import contextlib
+import threading
+import time
+import typing
+
+import ibis
+import ibis.client
+import pandas
+
+from .cancel import current_token
+from .params import current_params
+from .tracer import tracer
+
+ibis_omniscidb = ibis.omniscidb
+
+if typing.TYPE_CHECKING:
+    from ibis.omniscidb.client import OmniSciDBClient
+
+__all__ = [
+    "ConnectionPool",
+    "configure_pool",
+    "close_pools",
+    "pooled_connection",
+    "drop_table",
+    "backend_key",
+    "execute_pooled",
+    "iter_batches_pooled",
+]
+
+# Defaults used when creating the pool for a new backend
+POOL_CONFIG: typing.Dict[str, typing.Any] = {
+    "min_size": 1,
+    "max_size": 4,
+    # Seconds after which unused connections above `min_size` are closed
+    "idle_timeout": 300.0,
+    # Seconds a connection can be idle before it is checked out without
+    # testing it first
+    "health_check_after": 30.0,
+}
+
+
+class ConnectionPool:
+    """
+    A thread safe pool of connections.
+
+    Each connection is checked out by one thread at a time. Nested
+    checkouts from the same thread get the connection the thread already holds.
+
+    Connections which have been idle for longer than `health_check_after`
+    seconds are tested before they are checked out, since the server may have
+    closed them in the meantime. Connections above `min_size` are closed once
+    they have been idle for `idle_timeout` seconds, by a timer if the pool
+    isn't used in the meantime.
+    """
+
+    def __init__(
+        self,
+        factory: typing.Callable[[], typing.Any],
+        min_size: int = 1,
+        max_size: int = 4,
+        idle_timeout: float = 300.0,
+        health_check_after: float = 30.0,
+        health_check: typing.Optional[typing.Callable[[typing.Any], bool]] = None,
+        close: typing.Optional[typing.Callable[[typing.Any], None]] = None,
+    ):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(
+                f"Invalid pool size min_size={min_size}, max_size={max_size}"
+            )
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.health_check = health_check
+        self._close = close
+        # Idle connections, with the time they were checked in
+        self._idle: typing.List[typing.Tuple[typing.Any, float]] = []
+        self._size = 0
+        # Whether the pool was closed, after which connections are closed
+        # when they are checked in
+        self._closed = False
+        # Prunes the idle connections once the oldest one times out
+        self._timer: typing.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+        for _ in range(min_size):
+            self._idle.append((self._create(), time.monotonic()))
+
+    @contextlib.contextmanager
+    def connection(self) -> typing.Iterator[typing.Any]:
+        """
+        Check out a connection for the duration of the `with` block.
+        """
+        held = getattr(self._local, "connection", None)
+        if held is not None:
+            yield held
+            return
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            self._local.connection = conn
+            try:
+                yield conn
+            except BaseException:
+                # The connection may be in a broken state, or have unread results
+                # if a generator using it was closed, so don't reuse it
+                self._discard(conn)
+                raise
+            else:
+                self._checkin(conn)
+            finally:
+                self._local.connection = None
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+        Close all idle connections, and the connections checked out now once
+        they are checked in.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _create(self) -> typing.Any:
+        conn = self.factory()
+        with self._lock:
+            self._size += 1
+        return conn
+
+    def _discard(self, conn: typing.Any) -> None:
+        with self._lock:
+            self._size -= 1
+        if self._close:
+            try:
+                self._close(conn)
+            except Exception:
+                pass
+
+    def _checkout(self) -> typing.Any:
+        self._prune()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, since = self._idle.pop()
+            # Connections that were used recently are most likely still open,
+            # and testing them would add a round trip to every query
+            recent = time.monotonic() - since <= self.health_check_after
+            if recent or self.health_check is None or self.health_check(conn):
+                return conn
+            self._discard(conn)
+        return self._create()
+
+    def _checkin(self, conn: typing.Any) -> None:
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._idle.append((conn, time.monotonic()))
+        if closed:
+            self._discard(conn)
+            return
+        self._prune()
+        self._schedule_prune()
+
+    def _schedule_prune(self) -> None:
+        """
+        Start a timer to prune the idle connections when the oldest one times
+        out, unless one is running or no connection would be closed.
+        """
+        with self._lock:
+            if (
+                self._timer is not None
+                or self._closed
+                or not self._idle
+                or self._size <= self.min_size
+            ):
+                return
+            delay = self._idle[0][1] + self.idle_timeout - time.monotonic()
+            self._timer = threading.Timer(max(delay, 0), self._on_timer)
+            # Don't keep the kernel from exiting
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+        self._prune()
+        self._schedule_prune()
+
+    def _prune(self) -> None:
+        """
+        Close connections that have been idle for longer than the timeout,
+        while keeping at least `min_size` connections open.
+        """
+        now = time.monotonic()
+        expired: typing.List[typing.Any] = []
+        with self._lock:
+            # Oldest connections are at the start of the list
+            while (
+                self._idle
+                and self._size - len(expired) > self.min_size
+                and now - self._idle[0][1] > self.idle_timeout
+            ):
+                expired.append(self._idle.pop(0)[0])
+        for conn in expired:
+            self._discard(conn)
+
+
+_pools: typing.Dict[tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def configure_pool(**config) -> None:
+    """
+    Set the `min_size`, `max_size`, `idle_timeout` and `health_check_after`
+    of the connection pools.
+
+    Existing pools are closed, so the new settings apply to the next query.
+    """
+    unknown = set(config) - set(POOL_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown pool options {unknown}")
+    POOL_CONFIG.update(config)
+    close_pools()
+
+
+def close_pools() -> None:
+    """
+    Close the idle connections of every pool and forget about the pools.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+@contextlib.contextmanager
+def pooled_connection(
+    backend: "OmniSciDBClient",
+) -> typing.Iterator["OmniSciDBClient"]:
+    """
+    Check out a pooled connection to the database of the backend.
+    """
+    with _get_pool(backend).connection() as client:
+        yield client
+
+
+def drop_table(backend: "OmniSciDBClient", name: str) -> None:
+    """
+    Drop a table created by this kernel, if it still exists. Errors are ignored,
+    since the table is not used anymore either way.
+    """
+    try:
+        with pooled_connection(backend) as client:
+            client.drop_table(name, force=True)
+    except Exception:
+        pass
+
+
+def backend_key(backend: typing.Any) -> tuple:
+    """
+    A key for the database a backend is connected to, which is the same for
+    every client connected to it. Other backends are only equal to themselves.
+    """
+    if not isinstance(backend, ibis_omniscidb.OmniSciDBClient):
+        return type(backend).__name__, id(backend)
+    return (
+        backend.uri,
+        backend.host,
+        backend.port,
+        backend.user,
+        backend.protocol,
+        backend.session_id,
+        backend.db_name,
+    )
+
+
+def _get_pool(backend: "OmniSciDBClient") -> ConnectionPool:
+    key = backend_key(backend)
+    with _pools_lock:
+        pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    # New pools open their first connections, so don't make queries on other
+    # databases wait for them
+    pool = ConnectionPool(
+        lambda: _new_client(backend),
+        health_check=_is_healthy,
+        close=lambda client: client.close(),
+        **POOL_CONFIG,
+    )
+    with _pools_lock:
+        existing = _pools.setdefault(key, pool)
+    if existing is not pool:
+        # Another thread created a pool for the database in the meantime
+        pool.close()
+    return existing
+
+
+def _new_client(
+    backend: "OmniSciDBClient",
+) -> "OmniSciDBClient":
+    with tracer.start_span("ibis:execute:new-client"):
+        return ibis_omniscidb.OmniSciDBClient(
+            uri=backend.uri,
+            host=backend.host,
+            port=backend.port,
+            user=backend.user,
+            protocol=backend.protocol,
+            session_id=backend.session_id,
+            database=backend.db_name,
+            password=backend.password,
+        )
+
+
+def _is_healthy(client: "OmniSciDBClient") -> bool:
+    try:
+        client.con.execute("SELECT 1")
+    except Exception:
+        return False
+    return True
+
+
+def _interrupt(client: "OmniSciDBClient") -> None:
+    """
+    Interrupt a running query by closing the socket of its connection,
+    which makes the blocked call fail. The pool discards the connection afterwards.
+    """
+    transport = getattr(client.con, "_transport", None)
+    if transport is not None:
+        transport.close()
+
+
+def execute_pooled(expr: ibis.Expr):
+    """
+    Execute an expression on a pooled connection, b/c connections are not threadsafe.
+
+    If the query of the current thread is cancelled while this runs, the
+    connection is interrupted. Expressions which are not backed by OmniSci
+    are executed directly. The parameters of the expression are bound to the
+    current parameter values.
+    """
+    token = current_token()
+    if token:
+        token.check()
+    params = current_params()
+    (backend,) = list(ibis.client.find_backends(expr))
+    if not isinstance(backend, ibis_omniscidb.OmniSciDBClient):
+        return expr.execute(params=params)
+    with _get_pool(backend).connection() as client:
+        if not token:
+            return client.execute(expr, params=params)
+        unregister = token.on_cancel(lambda: _interrupt(client))
+        try:
+            return client.execute(expr, params=params)
+        finally:
+            unregister()
+            token.check()
+
+
+def iter_batches_pooled(
+    expr: ibis.Expr, batch_size: int
+) -> typing.Iterator[pandas.DataFrame]:
+    """
+    Execute an expression on a pooled connection and yield the result in
+    batches of at most `batch_size` rows, as they are fetched from the cursor.
+
+    The first batch is always yielded, even if it is empty. Expressions which
+    are not backed by OmniSci are executed directly and then split into batches.
+    """
+    token = current_token()
+    if token:
+        token.check()
+    params = current_params()
+    (backend,) = list(ibis.client.find_backends(expr))
+    if not isinstance(backend, ibis_omniscidb.OmniSciDBClient):
+        data = expr.execute(params=params)
+        for start in range(0, max(len(data), 1), batch_size):
+            yield data.iloc[start : start + batch_size]
+        return
+    sql = expr.compile(params=params)
+    with _get_pool(backend).connection() as client:
+        unregister = (
+            token.on_cancel(lambda: _interrupt(client)) if token else lambda: None
+        )
+        try:
+            cursor = client.con.execute(sql)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchmany(batch_size)
+            yield pandas.DataFrame.from_records(rows, columns=columns)
+            while rows:
+                if token:
+                    token.check()
+                rows = cursor.fetchmany(batch_size)
+                if rows:
+                    yield pandas.DataFrame.from_records(rows, columns=columns)
+        finally:
+            unregister()
+            if token:
+                token.check()
@@ -2,76 +2,432 @@
 Functionality for server-side ibis transforms of vega charts.
 """
 import json
-import re
 import typing
+import threading
 import concurrent.futures
 
-import ibis.client
-
 import ibis
-
-ibis_omniscidb = ibis.omniscidb
-
-import altair
-import altair.vegalite.v3.display
 import opentracing
+import pandas
 
+from .cache import CacheKey, cache_key, result_cache
+from .cancel import CancelToken, QueryCancelled, use_token
 from .core import apply
-from .globals import _expr_map, debug
+from .crossfilter import crossfilter_query
+from .downsample import DownsampleSpec, downsample
+from .encoding import Buffers, encode_result
+from .globals import (
+    debug,
+    get_preview_sample,
+    get_result_encoding,
+    get_stream_batch_size,
+)
+from .params import current_params, parametrize, use_params
+from .pool import execute_pooled, iter_batches_pooled
+from .registry import expression_registry
+from .selection_tables import hold_selection_tables
 from .tracer import tracer
+from .vegaexpr import Bindings
 
-__all__ = ["query_target_func"]
+__all__ = ["query_target_func", "batch_query_target_func", "prefetch"]
 
 executor = concurrent.futures.ThreadPoolExecutor()
 
 
-# We need a new connection per thread, which is too memory intensive
-# Should just create one per threadpool and then reuse
-# But for now we just disable
+# Execute queries on a thread pool, using pooled connections
+# b/c connections are not threadsafe.
+
+ENABLE_MULTIPROCESSING = True
 
-ENABLE_MULTIPROCESSING = False
 
+# The token of the in-flight query for each data source of the frontend,
+# so that a newer query for the same data source cancels the older one.
+_inflight: typing.Dict[str, CancelToken] = {}
+_inflight_lock = threading.Lock()
 
-def execute_new_client(expr):
+
+class _Waiter:
     """
-    Execute with new connection b/c connections are not threadsafe
+    Something waiting for the result of a query.
     """
-    (backend,) = list(ibis.client.find_backends(expr))
-    assert isinstance(backend, ibis_omniscidb.OmniSciDBClient)
-    with tracer.start_span("ibis:execute:new-client") as execute_span:
-        new_client = ibis_omniscidb.OmniSciDBClient(
-            uri=backend.uri,
-            host=backend.host,
-            port=backend.port,
-            user=backend.user,
-            protocol=backend.protocol,
-            session_id=backend.session_id,
-            database=backend.db_name,
-            password=backend.password,
-        )
-    with new_client:
-        return new_client.execute(expr)
 
-    # reset db name so it reconnects
+    def __init__(self, source: typing.Optional[str]):
+        self.source = source
+        self.token = CancelToken()
+
+    def send_batch(self, data: pandas.DataFrame, done: bool) -> None:
+        raise NotImplementedError()
+
+    def send_preview(self, data: pandas.DataFrame) -> None:
+        """
+        Waiters which can't show a preview of the result ignore it.
+        """
+
+    def send_result(self, data: pandas.DataFrame) -> None:
+        raise NotImplementedError()
+
+    def send_cancelled(self) -> None:
+        raise NotImplementedError()
+
+    def send_error(self, error: Exception) -> None:
+        raise NotImplementedError()
+
+
+class _CommWaiter(_Waiter):
+    """
+    A `queryibis` comm waiting for the result of its query.
+    """
+
+    def __init__(self, comm, encoding: str, source: typing.Optional[str]):
+        super().__init__(source)
+        self.comm = comm
+        self.encoding = encoding
+
+    def send_batch(self, data: pandas.DataFrame, done: bool) -> None:
+        if self.token.cancelled:
+            return
+        content, buffers = encode_result(data, self.encoding)
+        self.comm.send({"batch": content, "done": done}, buffers=buffers)
+
+    def send_preview(self, data: pandas.DataFrame) -> None:
+        if self.token.cancelled:
+            return
+        content, buffers = encode_result(data, self.encoding)
+        self.comm.send({"preview": content}, buffers=buffers)
+
+    def send_result(self, data: pandas.DataFrame) -> None:
+        if self.token.cancelled:
+            self.send_cancelled()
+            return
+        content, buffers = encode_result(data, self.encoding)
+        self.comm.send(content, buffers=buffers)
+
+    def send_cancelled(self) -> None:
+        self.comm.send({"cancelled": True})
+
+    def send_error(self, error: Exception) -> None:
+        self.comm.send({"error": str(error)})
+
+
+class _Batch:
+    """
+    The queries of a `queryibis:batch` comm, which are answered together
+    in one message once all of them are done.
+
+    The reply is `{"results": [{"result": <content>, "buffers": [<start>, <count>]}]}`,
+    where the binary buffers of each result are a slice of the buffers of the message.
+
+    Previews and streamed batches are sent as soon as they are ready, as
+    `{"index": <index>, "preview": <content>}` and
+    `{"index": <index>, "batch": <content>, "done": <done>}`. The result of a
+    streamed query is then `{"streamed": true}`.
+    """
+
+    def __init__(self, comm, size: int):
+        self.comm = comm
+        self._results: typing.List[typing.Optional[tuple]] = [None] * size
+        self._remaining = size
+        self._lock = threading.Lock()
+
+    def send(self, index: int, message: dict, buffers: Buffers) -> None:
+        """
+        Send a message for one of the queries right away.
+        """
+        self.comm.send({"index": index, **message}, buffers=buffers)
+
+    def set_result(self, index: int, content: typing.Any, buffers: Buffers) -> None:
+        with self._lock:
+            if self._results[index] is not None:
+                return
+            self._results[index] = (content, buffers)
+            self._remaining -= 1
+            if self._remaining:
+                return
+        results = []
+        all_buffers: Buffers = []
+        for content, buffers in typing.cast(typing.List[tuple], self._results):
+            results.append(
+                {"result": content, "buffers": [len(all_buffers), len(buffers)]}
+            )
+            all_buffers.extend(buffers)
+        self.comm.send({"results": results}, buffers=all_buffers)
+
+
+class _BatchWaiter(_Waiter):
+    """
+    One of the queries of a batch.
+    """
+
+    def __init__(
+        self, batch: _Batch, index: int, encoding: str, source: typing.Optional[str]
+    ):
+        super().__init__(source)
+        self.batch = batch
+        self.index = index
+        self.encoding = encoding
+
+    def send_batch(self, data: pandas.DataFrame, done: bool) -> None:
+        if self.token.cancelled:
+            return
+        content, buffers = encode_result(data, self.encoding)
+        self.batch.send(self.index, {"batch": content, "done": done}, buffers)
+        if done:
+            self.batch.set_result(self.index, {"streamed": True}, [])
+
+    def send_preview(self, data: pandas.DataFrame) -> None:
+        if self.token.cancelled:
+            return
+        content, buffers = encode_result(data, self.encoding)
+        self.batch.send(self.index, {"preview": content}, buffers)
+
+    def send_result(self, data: pandas.DataFrame) -> None:
+        if self.token.cancelled:
+            self.send_cancelled()
+            return
+        self.batch.set_result(self.index, *encode_result(data, self.encoding))
+
+    def send_cancelled(self) -> None:
+        self.batch.set_result(self.index, {"cancelled": True}, [])
+
+    def send_error(self, error: Exception) -> None:
+        self.batch.set_result(self.index, {"error": str(error)}, [])
+
+
+class _PrefetchWaiter(_Waiter):
+    """
+    Waits for a prefetched query, whose result only needs to be cached.
+    """
+
+    def send_batch(self, data: pandas.DataFrame, done: bool) -> None:
+        pass
+
+    def send_result(self, data: pandas.DataFrame) -> None:
+        pass
+
+    def send_cancelled(self) -> None:
+        pass
+
+    def send_error(self, error: Exception) -> None:
+        pass
+
+
+class _Flight:
+    """
+    A query which is executed once for all the waiters that requested it
+    while it was pending.
+
+    The query is cancelled once all of its waiters are.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.token = CancelToken()
+        # Waiters can't join once the first batch of a streamed result was sent
+        self.joinable = True
+        self._waiters: typing.List[_Waiter] = []
+        self._lock = threading.Lock()
+
+    def add(self, waiter: _Waiter) -> None:
+        with self._lock:
+            self._waiters.append(waiter)
+        waiter.token.on_cancel(self._on_waiter_cancelled)
+
+    def waiters(self) -> typing.List[_Waiter]:
+        with self._lock:
+            return list(self._waiters)
+
+    def send_batch(self, data: pandas.DataFrame, done: bool) -> None:
+        with _flights_lock:
+            self.joinable = False
+        for waiter in self.waiters():
+            waiter.send_batch(data, done)
+
+    def send_preview(self, data: pandas.DataFrame) -> None:
+        for waiter in self.waiters():
+            waiter.send_preview(data)
+
+    def _on_waiter_cancelled(self) -> None:
+        if all(waiter.token.cancelled for waiter in self.waiters()):
+            self.token.cancel()
+
+
+# Pending queries by their parameters, to coalesce identical requests
+_flights: typing.Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def _flight_key(parameters: dict, streamed: bool) -> str:
+    """
+    Identical requests have the same parameters, except for their tracing span.
+    Requests which may be streamed only match each other, unless streaming is off.
+    """
+    return json.dumps(
+        {
+            "parameters": {k: v for k, v in parameters.items() if k != "span"},
+            "streamed": streamed and get_stream_batch_size() is not None,
+        },
+        sort_keys=True,
+        default=str,
+    )
+
+
+def _parse_request(parameters: dict) -> typing.Tuple[typing.Optional[str], str]:
+    """
+    Pop the data source and result encoding from the parameters of a query.
+    """
+    source: typing.Optional[str] = parameters.pop("source", None)
+    # Frontends which can decode columnar results ask for them
+    encoding = parameters.pop("encoding", "json")
+    if get_result_encoding() == "json":
+        encoding = "json"
+    return source, encoding
 
 
 def query_target_func(comm, msg):
     """
     Target function for actually evaluating the `queryibis` transform.
+
+    The query runs off the kernel's main thread. It is cancelled when the frontend
+    sends a `cancel` message on the comm, or when a newer query is opened for the
+    same data source. Cancelled queries reply with `{"cancelled": true}` and
+    failed ones with `{"error": <message>}`.
+
+    Identical requests that arrive while a query is pending share its result.
     """
     # These are the paramaters passed to the vega transform
     parameters: dict = msg["content"]["data"]
+    source, encoding = _parse_request(parameters)
+    waiter = _CommWaiter(comm, encoding, source)
+
+    def on_msg(msg):
+        if msg["content"]["data"].get("type") == "cancel":
+            waiter.token.cancel()
+
+    comm.on_msg(on_msg)
+    _submit(parameters, waiter, streamed=True)
+
+
+def batch_query_target_func(comm, msg):
+    """
+    Target function for evaluating all the `queryibis` transforms of one pulse
+    together, answering them with a single message.
+
+    The queries are sent as `{"queries": [<parameters>]}`, and one of them can be
+    cancelled with a `{"type": "cancel", "index": <index>}` message.
+    Previews and streamed batches of a query are sent on their own, with its index.
+    """
+    queries: typing.List[dict] = msg["content"]["data"]["queries"]
+    batch = _Batch(comm, len(queries))
+    waiters = []
+    for index, parameters in enumerate(queries):
+        source, encoding = _parse_request(parameters)
+        waiters.append(_BatchWaiter(batch, index, encoding, source))
+
+    def on_msg(msg):
+        data = msg["content"]["data"]
+        if data.get("type") == "cancel":
+            waiters[data["index"]].token.cancel()
+
+    comm.on_msg(on_msg)
+    for parameters, waiter in zip(queries, waiters):
+        _submit(parameters, waiter, streamed=True)
+
+
+def prefetch(parameters: dict) -> None:
+    """
+    Start executing a query in the background, before the frontend asks for it.
+
+    The result ends up in the result cache, and requests arriving while it runs
+    share it. Does nothing if queries are executed on the main thread.
+    """
+    if ENABLE_MULTIPROCESSING:
+        _submit(parameters, _PrefetchWaiter(None), streamed=False)
+
+
+def _submit(parameters: dict, waiter: _Waiter, streamed: bool) -> None:
+    """
+    Execute a query for the waiter, or have it join an identical pending query.
+    """
+    if waiter.source is not None:
+        with _inflight_lock:
+            previous = _inflight.get(waiter.source)
+            _inflight[waiter.source] = waiter.token
+        if previous:
+            previous.cancel()
+
+    key = _flight_key(parameters, streamed)
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None or not flight.joinable or flight.token.cancelled
+        if flight is None or leader:
+            flight = _flights[key] = _Flight(key)
+        flight.add(waiter)
+    if not leader:
+        return
+
+    def run():
+        # Selection tables evicted while the query runs are kept until it's done
+        with use_token(flight.token), hold_selection_tables():
+            if streamed:
+                return execute_query(parameters, flight.send_batch, flight.send_preview)
+            return execute_query(parameters)
 
     def callback(future):
-        comm.send(future.result())
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        waiters = flight.waiters()
+        with _inflight_lock:
+            for w in waiters:
+                if w.source is not None and _inflight.get(w.source) is w.token:
+                    del _inflight[w.source]
+        try:
+            data = future.result()
+        except (QueryCancelled, concurrent.futures.CancelledError):
+            for w in waiters:
+                w.send_cancelled()
+            return
+        except Exception as e:
+            # Reply so the frontend isn't left waiting, then raise to log the error
+            for w in waiters:
+                w.send_error(e)
+            raise
+        if data is None:
+            # The result was streamed with `send_batch`
+            return
+        for w in waiters:
+            w.send_result(data)
 
     if ENABLE_MULTIPROCESSING:
-        executor.submit(execute_query, parameters).add_done_callback(callback)
+        future = executor.submit(run)
+        # Queries which haven't started yet can be dropped from the queue
+        flight.token.on_cancel(future.cancel)
+        future.add_done_callback(callback)
     else:
-        comm.send(execute_query(parameters))
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(run())
+        except Exception as e:
+            future.set_exception(e)
+        callback(future)
+
+
+def execute_query(
+    parameters: dict,
+    send_batch: typing.Optional[
+        typing.Callable[[pandas.DataFrame, bool], None]
+    ] = None,
+    send_preview: typing.Optional[typing.Callable[[pandas.DataFrame], None]] = None,
+) -> typing.Optional[pandas.DataFrame]:
+    """
+    Execute the query described by the parameters of a `queryibis` transform.
 
+    If streaming is enabled and `send_batch` is given, uncached results are passed
+    to it in batches as they are fetched, and None is returned.
 
-def execute_query(parameters: dict):
+    If previews are enabled and `send_preview` is given, uncached results of
+    aggregations are first computed on a sample of the rows and passed to it.
+    """
     injected_span: object = parameters.pop("span")
     with tracer.start_active_span(
         "queryibis",
@@ -83,53 +439,138 @@ def execute_query(parameters: dict):
     ) as scope:
         scope.span.log_kv(parameters)
         name: str = parameters.pop("name")
-        transforms: typing.Optional[str] = parameters.pop("transform", None)
+        transforms: typing.Optional[typing.List[dict]] = parameters.pop(
+            "transform", None
+        )
 
-        if name not in _expr_map:
+        expr = expression_registry.get(name)
+        if expr is None:
             raise ValueError(f"{name} is not an expression known to us!")
-        expr = _expr_map[name]
+        key = cache_key(name, transforms, parameters)
+        cached = result_cache.get(key)
+        if cached is not None:
+            scope.span.log_kv({"cache": "hit"})
+            debug("query:result", {"transforms": transforms, "cache": "hit"})
+            return cached
         sql = expr.compile()
         scope.span.log_kv({"sql:initial": sql})
         debug(
             "query:initial",
             {"transforms": transforms, "parameters": parameters, "sql": sql},
         )
-        if transforms:
-            # Replace all string instances of data references with value in schema
-            for k, v in parameters.items():
-                # All data items are added to parameters as `:<data name>`.
-                # They also should  be in the `data` paramater, but you have to call
-                # this with a tuple which I am not sure where to get from
-                # https://github.com/vega/vega/blob/65fe7cb2485be90e16298d9dff87bf56045afb8d/packages/vega-transforms/src/Filter.js#L48
-                if not k.startswith(":"):
-                    continue
-                k = k[1:]
-                res = json.dumps(v)
-                for t in transforms:
-                    if t["type"] == "filter" or t["type"] == "formula":
-                        t["expr"] = _patch_vegaexpr(t["expr"], k, res)
-            try:
-                expr = apply(expr, transforms)
-            except Exception as e:
-                raise ValueError(
-                    f"Failed to convert {transforms} with error message message '{e}'"
-                )
-        with tracer.start_span("ibis:execute") as execute_span:
-            sql = expr.compile()
+        # All data items are added to parameters as `:<data name>`.
+        # They also should  be in the `data` paramater, but you have to call
+        # this with a tuple which I am not sure where to get from
+        # https://github.com/vega/vega/blob/65fe7cb2485be90e16298d9dff87bf56045afb8d/packages/vega-transforms/src/Filter.js#L48
+        bindings = {k[1:]: v for k, v in parameters.items() if k.startswith(":")}
+        if transforms and not parameters.get("downsample"):
+            data = crossfilter_query(expr, name, transforms, bindings)
+            if data is not None:
+                scope.span.log_kv({"crossfilter": "hit"})
+                debug("query:result", {"transforms": transforms, "crossfilter": "hit"})
+                return data
+        # Selections are bound as query parameters, so the expression only
+        # changes shape when the selections do
+        bindings, values = parametrize(bindings)
+        with use_params(values):
+            return _execute(
+                expr,
+                name,
+                transforms,
+                bindings,
+                parameters.get("downsample"),
+                key,
+                send_batch,
+                send_preview,
+            )
+
+
+def _execute(
+    expr: ibis.Expr,
+    name: str,
+    transforms: typing.Optional[typing.List[dict]],
+    bindings: Bindings,
+    downsample_spec: typing.Optional[DownsampleSpec],
+    key: CacheKey,
+    send_batch: typing.Optional[typing.Callable[[pandas.DataFrame, bool], None]],
+    send_preview: typing.Optional[typing.Callable[[pandas.DataFrame], None]],
+) -> typing.Optional[pandas.DataFrame]:
+    """
+    Apply the transforms to the expression and execute it, with the values
+    of its parameters bound.
+    """
+    sample = get_preview_sample()
+    if send_preview and sample and _aggregates(transforms):
+        with tracer.start_span("ibis:execute:preview") as preview_span:
+            preview = _apply(expr, transforms, None, bindings, sample)
+            if downsample_spec:
+                preview = downsample(preview, downsample_spec)
+            preview_span.log_kv({"sql": preview.compile(params=current_params())})
+            send_preview(_run(preview))
+    expr = _apply(expr, transforms, name, bindings)
+    if downsample_spec:
+        expr = downsample(expr, downsample_spec)
+    params = current_params()
+    batch_size = get_stream_batch_size()
+    if send_batch and batch_size:
+        with tracer.start_span("ibis:execute:stream") as execute_span:
+            sql = expr.compile(params=params)
             execute_span.log_kv({"sql": sql})
-            if ENABLE_MULTIPROCESSING:
-                data = execute_new_client(expr)
-            else:
-                data = expr.execute()
-        values = altair.to_values(data)["values"]
-        debug("query:result", {"transforms": transforms, "sql": sql, "values": values})
-        return values
-
-
-def _patch_vegaexpr(expr: str, name: str, value: str) -> str:
-    quote = "(['\"])"
-    expr = re.sub(f"data\({quote}{name}{quote}\)", value, expr)
-    expr = re.sub(
-        f"vlSelectionTest\({quote}{name}{quote}", f"vlSelectionTest({value}", expr
-    )
-    return expr
+            _stream(expr, batch_size, send_batch)
+        debug("query:result", {"transforms": transforms, "sql": sql})
+        return None
+    with tracer.start_span("ibis:execute") as execute_span:
+        sql = expr.compile(params=params)
+        execute_span.log_kv({"sql": sql})
+        data = _run(expr)
+    result_cache.put(key, data, int(data.memory_usage(deep=True).sum()))
+    debug("query:result", {"transforms": transforms, "sql": sql, "rows": len(data)})
+    return data
+
+
+def _apply(
+    expr: ibis.Expr,
+    transforms: typing.Optional[typing.List[dict]],
+    name: typing.Optional[str],
+    bindings: Bindings,
+    sample: typing.Optional[float] = None,
+) -> ibis.Expr:
+    if not transforms:
+        return expr
+    try:
+        return apply(expr, transforms, name, bindings, sample)
+    except QueryCancelled:
+        raise
+    except Exception as e:
+        raise ValueError(
+            f"Failed to convert {transforms} with error message message '{e}'"
+        )
+
+
+def _run(expr: ibis.Expr) -> pandas.DataFrame:
+    if ENABLE_MULTIPROCESSING:
+        return execute_pooled(expr)
+    return expr.execute(params=current_params())
+
+
+def _aggregates(transforms: typing.Optional[typing.List[dict]]) -> bool:
+    return any(t["type"] == "aggregate" for t in transforms or [])
+
+
+def _stream(
+    expr: ibis.Expr,
+    batch_size: int,
+    send_batch: typing.Callable[[pandas.DataFrame, bool], None],
+) -> None:
+    """
+    Send the result of the expression in batches, marking the last one as done.
+
+    Streamed results are not cached, so that the kernel doesn't have to hold
+    the whole result.
+    """
+    batches = iter_batches_pooled(expr, batch_size)
+    previous = next(batches)
+    for batch in batches:
+        send_batch(previous, False)
+        previous = batch
+    send_batch(previous, True)
@@ -0,0 +1,254 @@
+"""
+Registry of the ibis expressions charts are built from, which the frontend
+refers to by key.
+
+Expressions are kept while a rendered view uses them, and otherwise evicted
+least recently used first once there are more than `max_size` of them, so
+re-running chart cells does not keep every expression alive.
+"""
+import collections
+import hashlib
+import json
+import threading
+import typing
+
+import ibis
+import ibis.client
+import ibis.expr.operations as ops
+
+from .cache import expression_cache, result_cache
+from .pool import backend_key
+
+__all__ = [
+    "ExpressionRegistry",
+    "expression_registry",
+    "set_registry_max_size",
+    "registry_stats",
+    "structural_key",
+]
+
+# By default, keep up to 256 expressions which are not used by a view.
+DEFAULT_MAX_SIZE = 256
+
+
+class ExpressionRegistry:
+    """
+    A thread safe LRU map from keys to ibis expressions, where entries with
+    references are never evicted.
+
+    Keys are derived from the SQL of the expression and the database it
+    queries, so equivalent expressions built separately, like the same filter
+    written in two cells, share a key and everything cached for it.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_MAX_SIZE,
+        on_evict: typing.Optional[typing.Callable[[str], None]] = None,
+    ):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._entries: "collections.OrderedDict[str, ibis.Expr]" = (
+            collections.OrderedDict()
+        )
+        self._refs: typing.Counter[str] = collections.Counter()
+        self._registered = 0
+        self._reused = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def register(self, expr: ibis.Expr, sql: typing.Any = None) -> str:
+        """
+        Add the expression to the registry, and return its key.
+
+        If an equivalent expression is already registered, it is kept and its
+        key is returned. `sql` is the compiled expression, if already known.
+        """
+        h = structural_key(expr, sql)
+        with self._lock:
+            self._registered += 1
+            # Resolve collisions between expressions which are not equivalent
+            key, i = h, 0
+            while key in self._entries and not _equivalent(
+                self._entries[key], expr, h
+            ):
+                i += 1
+                key = f"{h}.{i}"
+            if key in self._entries:
+                self._reused += 1
+                self._entries.move_to_end(key)
+                return key
+            self._entries[key] = expr
+            evicted = self._shrink()
+        self._evicted(evicted)
+        return key
+
+    def get(self, key: str) -> typing.Optional[ibis.Expr]:
+        """
+        Returns the expression for the key, or None if it is not registered.
+        """
+        with self._lock:
+            expr = self._entries.get(key)
+            if expr is not None:
+                self._entries.move_to_end(key)
+            return expr
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def keys_reading(self, expr: ibis.Expr) -> typing.List[str]:
+        """
+        The keys of the registered expressions which read any of the tables
+        the expression reads.
+        """
+        tables = _tables(expr)
+        with self._lock:
+            entries = list(self._entries.items())
+        return [key for key, e in entries if tables & _tables(e)]
+
+    def acquire(self, keys: typing.Iterable[str]) -> None:
+        """
+        Add a reference to each of the expressions, which keeps them registered
+        until it is released.
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._refs[key] += 1
+
+    def release(self, keys: typing.Iterable[str]) -> None:
+        """
+        Remove a reference to each of the expressions, added by `acquire`.
+        """
+        with self._lock:
+            for key in keys:
+                if self._refs[key] > 0:
+                    self._refs[key] -= 1
+                if self._refs[key] == 0:
+                    del self._refs[key]
+            evicted = self._shrink()
+        self._evicted(evicted)
+
+    def resize(self, max_size: int) -> None:
+        with self._lock:
+            self.max_size = max_size
+            evicted = self._shrink()
+        self._evicted(evicted)
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return {
+                "registered": self._registered,
+                "reused": self._reused,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "referenced": len(self._refs),
+                "max_size": self.max_size,
+            }
+
+    def _shrink(self) -> typing.List[str]:
+        """
+        Evict the least recently used expressions without references,
+        until we are under the size limit. Returns their keys.
+        """
+        evicted = []
+        excess = len(self._entries) - self.max_size
+        for key in list(self._entries):
+            if excess <= 0:
+                break
+            if self._refs[key]:
+                continue
+            del self._entries[key]
+            evicted.append(key)
+            excess -= 1
+        self._evictions += len(evicted)
+        return evicted
+
+    def _evicted(self, keys: typing.List[str]) -> None:
+        # Called outside of the lock, since the callback may be slow
+        if self.on_evict is None:
+            return
+        for key in keys:
+            self.on_evict(key)
+
+
+def structural_key(expr: ibis.Expr, sql: typing.Any = None) -> str:
+    """
+    A digest of the database and the SQL of an expression, or of its
+    structure if it doesn't compile to SQL.
+    """
+    if sql is None:
+        try:
+            sql = expr.compile()
+        except Exception:
+            sql = None
+    if not isinstance(sql, str):
+        return f"h{hash(expr) & 0xFFFFFFFFFFFFFFFF:x}"
+    backends = [backend_key(b) for b in ibis.client.find_backends(expr)]
+    canonical = json.dumps([backends, sql], default=str)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+def _tables(expr: ibis.Expr) -> typing.Set[typing.Hashable]:
+    """
+    Keys for the tables in the database an expression reads.
+    """
+    tables: typing.Set[typing.Hashable] = set()
+    seen: typing.Set[int] = set()
+    stack: typing.List[typing.Any] = [expr]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (list, tuple)):
+            stack.extend(value)
+            continue
+        if not isinstance(value, ibis.Expr) or id(value.op()) in seen:
+            continue
+        op = value.op()
+        seen.add(id(op))
+        if isinstance(op, ops.DatabaseTable):
+            tables.add((op.name, backend_key(op.source)))
+        elif isinstance(op, ops.PhysicalTable):
+            tables.add(id(op))
+        else:
+            stack.extend(op.args)
+    return tables
+
+
+def _equivalent(registered: ibis.Expr, expr: ibis.Expr, key: str) -> bool:
+    # Digests of the SQL don't collide, hashes of the structure may
+    if not key.startswith("h"):
+        return True
+    return registered.equals(expr)
+
+
+def _on_evict(key: str) -> None:
+    # The results, memoized expressions, rollups and indexes of an evicted
+    # expression can't be requested anymore, since the frontend only knows it
+    # by its key.
+    result_cache.invalidate(key)
+    expression_cache.invalidate(key)
+    # Imported here, b/c these modules look up expressions in the registry
+    from .crossfilter import drop_indexes
+    from .rollup import drop_rollups
+
+    drop_rollups(key)
+    drop_indexes(key)
+
+
+expression_registry = ExpressionRegistry(on_evict=_on_evict)
+
+
+def set_registry_max_size(max_size: int) -> None:
+    """
+    Set the number of expressions to keep around which are not used by any
+    rendered view. Expressions used by a view are always kept.
+    """
+    expression_registry.resize(max_size)
+
+
+def registry_stats() -> typing.Dict[str, int]:
+    """
+    Returns the counters and the number of entries of the expression registry.
+    """
+    return expression_registry.stats()
@@ -0,0 +1,335 @@
+"""
+Pre-aggregated rollup tables, which answer the aggregations of a chart from
+far fewer rows than the table they were built from, as long as the transforms
+before the aggregation only read the dimensions of the rollup.
+
+The tables are named after the session of this kernel, which only drops the
+tables it created, and drops all of them when it exits.
+"""
+import atexit
+import collections
+import hashlib
+import json
+import threading
+import typing
+
+import ibis
+import ibis.client
+
+from .globals import SESSION_ID
+from .optimize import expression_fields
+from .pool import drop_table, execute_pooled, ibis_omniscidb, pooled_connection
+from .registry import expression_registry
+from .tracer import tracer
+from .util import promote_list
+from .vegaexpr import Bindings
+
+__all__ = ["Rollup", "requirements", "build_rollup", "rewrite", "drop_rollups"]
+
+# Rollups with more rows than this fraction of the rows of their table are
+# dropped, since they would not make queries much faster
+MAX_ROLLUP_RATIO = 0.1
+
+TABLE_PREFIX = f"ibis_vega_rollup_{SESSION_ID}_"
+
+# A value stored for each row of a rollup, as an op and the field it aggregates
+Measure = typing.Tuple[str, str]
+
+COUNT: Measure = ("count", "*")
+
+# The ops of the measures each vega aggregate op is computed from
+OP_MEASURES: typing.Dict[str, typing.List[str]] = {
+    "valid": ["valid"],
+    "missing": ["valid"],
+    "sum": ["sum"],
+    "mean": ["sum", "valid"],
+    "average": ["sum", "valid"],
+    "min": ["min"],
+    "max": ["max"],
+}
+
+
+class Rollup:
+    """
+    A table with one row per combination of values of the dimensions,
+    and a column for each measure.
+    """
+
+    def __init__(
+        self,
+        table: ibis.Expr,
+        dimensions: typing.Set[str],
+        columns: typing.Dict[Measure, str],
+    ):
+        self.table = table
+        self.dimensions = dimensions
+        self.columns = columns
+
+    def covers(
+        self, dimensions: typing.Set[str], measures: typing.Set[Measure]
+    ) -> bool:
+        return dimensions <= self.dimensions and measures <= self.columns.keys()
+
+    def aggregate(self, transform: dict) -> typing.List[dict]:
+        """
+        Rewrite an aggregate transform into transforms which compute
+        it from the measures of the rollup.
+        """
+        ops = transform.get("ops", ["count"])
+        fields = transform.get("fields", [None] * len(ops))
+        as_ = transform.get("as", [None] * len(ops))
+        aggregate: dict = {
+            "type": "aggregate",
+            "groupby": transform.get("groupby", []),
+            "fields": [],
+            "ops": [],
+            "as": [],
+        }
+        formulas = []
+        names = []
+
+        def add(op: str, measure: Measure, name: str) -> None:
+            aggregate["fields"].append(self.columns[measure])
+            aggregate["ops"].append(op)
+            aggregate["as"].append(name)
+
+        for i, (field, op, name) in enumerate(zip(fields, ops, as_)):
+            name = name or (f"{op}_{field}" if field else op)
+            names.append(name)
+            count, valid, sum_ = (
+                f"__rollup_{m}_{i}" for m in ("count", "valid", "sum")
+            )
+            if op == "count":
+                add("sum", COUNT, name)
+            elif op in ("valid", "sum"):
+                add("sum", (op, field), name)
+            elif op in ("min", "max"):
+                add(op, (op, field), name)
+            elif op == "missing":
+                add("sum", COUNT, count)
+                add("sum", ("valid", field), valid)
+                formulas.append(
+                    {
+                        "type": "formula",
+                        "expr": f'datum["{count}"] - datum["{valid}"]',
+                        "as": name,
+                    }
+                )
+            else:
+                add("sum", ("sum", field), sum_)
+                add("sum", ("valid", field), valid)
+                mean = f'datum["{sum_}"] / datum["{valid}"]'
+                formulas.append(
+                    {
+                        "type": "formula",
+                        "expr": f'if(datum["{valid}"] > 0, {mean}, null)',
+                        "as": name,
+                    }
+                )
+        if not formulas:
+            return [aggregate]
+        # Only keep the columns the aggregate would have had
+        columns = promote_list(aggregate["groupby"]) + names
+        return [aggregate] + formulas + [{"type": "project", "fields": columns}]
+
+
+# Rollups by the name of the expression they were built from
+_rollups: typing.Dict[str, typing.List[Rollup]] = {}
+_building: typing.Set[str] = set()
+# Dimensions of the rollups that were too large, by the name of their expression.
+# Rollups with more dimensions would be at least as large.
+_rejected: typing.Dict[str, typing.List[typing.Set[str]]] = {}
+# Counts the drops of the rollups of each expression, and of all of them under
+# None, so builds running during a drop don't add their rollup afterwards
+_drops: typing.Counter[typing.Optional[str]] = collections.Counter()
+# Set when the kernel exits, after which no rollups are built
+_closed = False
+_rollups_lock = threading.Lock()
+
+
+def requirements(
+    transforms: typing.Any, bindings: Bindings
+) -> typing.Optional[typing.Tuple[typing.Set[str], typing.Set[Measure]]]:
+    """
+    The dimensions and measures a rollup needs, to answer the transforms up to
+    their first aggregate. Returns None if they can't be answered by a rollup.
+    """
+    # The columns of the table each computed column is derived from
+    derived: typing.Dict[str, typing.Set[str]] = {}
+    dimensions: typing.Set[str] = set()
+
+    def source(columns: typing.Iterable[str]) -> typing.Set[str]:
+        return set().union(*(derived.get(c, {c}) for c in columns))
+
+    for t in promote_list(transforms):
+        type_ = t["type"]
+        if type_ == "aggregate":
+            ops = t.get("ops", ["count"])
+            measures = set()
+            for field, op in zip(t.get("fields", [None] * len(ops)), ops):
+                if op == "count":
+                    measures.add(COUNT)
+                    continue
+                if op not in OP_MEASURES or not field or field in derived:
+                    return None
+                measures.update((m, field) for m in OP_MEASURES[op])
+                if op == "missing":
+                    measures.add(COUNT)
+            groupby = promote_list(t.get("groupby", []))
+            return dimensions | source(groupby), measures
+        if type_ in ("filter", "formula"):
+            fields = expression_fields(t["expr"], bindings)
+            if fields is None:
+                return None
+            fields = source(fields)
+        elif type_ == "bin":
+            # Bins read the extent of a field, which may not be the binned one
+            extent = t.get("extent")
+            read = [t["field"]] + ([extent] if isinstance(extent, str) else [])
+            fields = source(read)
+        elif type_ == "timeunit":
+            fields = source([t["field"]])
+        elif type_ == "extent":
+            continue
+        else:
+            return None
+        dimensions |= fields
+        for as_ in promote_list(t.get("as", [])):
+            derived[as_] = fields
+    return None
+
+
+def rewrite(
+    name: str, transforms: typing.List[dict], bindings: Bindings
+) -> typing.Optional[typing.Tuple[ibis.Expr, typing.List[dict]]]:
+    """
+    If a rollup of the expression `name` can answer the transforms, returns
+    its table and the transforms rewritten to read from it.
+    """
+    with _rollups_lock:
+        rollups = list(_rollups.get(name, []))
+    if not rollups:
+        return None
+    required = requirements(transforms, bindings)
+    if required is None:
+        return None
+    rollup = next((r for r in rollups if r.covers(*required)), None)
+    if rollup is None:
+        return None
+    for i, t in enumerate(transforms):
+        if t["type"] == "aggregate":
+            return (
+                rollup.table,
+                transforms[:i] + rollup.aggregate(t) + transforms[i + 1 :],
+            )
+    return None
+
+
+def build_rollup(
+    name: str, dimensions: typing.Set[str], measures: typing.Set[Measure]
+) -> None:
+    """
+    Create a rollup of the expression `name` in its database, unless an
+    existing one covers the dimensions and measures, or it would be too large.
+    """
+    expr = expression_registry.get(name)
+    if expr is None or not dimensions <= set(expr.columns):
+        return
+    if any(field != "*" and field not in expr.columns for _, field in measures):
+        return
+    (backend,) = list(ibis.client.find_backends(expr))
+    if not isinstance(backend, ibis_omniscidb.OmniSciDBClient):
+        return
+    measures = measures | {COUNT}
+    columns = {m: f"__{m[0]}_{i}" for i, m in enumerate(sorted(measures))}
+    rollup_expr = expr.group_by(sorted(dimensions)).aggregate(
+        [_measure(expr, m).name(columns[m]) for m in sorted(measures)]
+    )
+    digest = hashlib.sha1(json.dumps(rollup_expr.compile()).encode()).hexdigest()
+    table_name = TABLE_PREFIX + digest[:24]
+    with _rollups_lock:
+        existing = _rollups.get(name, [])
+        if (
+            _closed
+            or table_name in _building
+            or any(r.covers(dimensions, measures) for r in existing)
+            or any(d <= dimensions for d in _rejected.get(name, []))
+        ):
+            return
+        _building.add(table_name)
+        drops = _drops[None], _drops[name]
+    try:
+        with tracer.start_span("rollup:build") as span:
+            span.log_kv({"table": table_name, "sql": rollup_expr.compile()})
+            try:
+                with pooled_connection(backend) as client:
+                    client.create_table(table_name, obj=rollup_expr)
+            except Exception:
+                # Don't leave a partially created table behind
+                drop_table(backend, table_name)
+                raise
+            table = backend.table_expr_class(
+                backend.table_class(table_name, rollup_expr.schema(), backend)
+            )
+            rows = execute_pooled(table.count())
+            total = execute_pooled(expr.count())
+            span.log_kv({"rows": rows, "table_rows": total})
+        with _rollups_lock:
+            # The rollups were dropped while this one was built, so it may be
+            # out of date, or the kernel is exiting
+            dropped = _closed or drops != (_drops[None], _drops[name])
+            rejected = rows > total * MAX_ROLLUP_RATIO
+            if not dropped and rejected:
+                _rejected.setdefault(name, []).append(set(dimensions))
+            elif not dropped:
+                _rollups.setdefault(name, []).append(
+                    Rollup(table, set(dimensions), columns)
+                )
+        if dropped or rejected:
+            drop_table(backend, table_name)
+    finally:
+        with _rollups_lock:
+            _building.discard(table_name)
+
+
+def drop_rollups(name: typing.Optional[str] = None) -> None:
+    """
+    Drop the rollups of the expression `name`, or all of them if no name is
+    given, for instance after the underlying table changed.
+    """
+    with _rollups_lock:
+        _drops[name] += 1
+        names = [name] if name is not None else list(_rollups)
+        dropped = [r for n in names for r in _rollups.pop(n, [])]
+        # The table may have changed size, so try building them again
+        if name is None:
+            _rejected.clear()
+        else:
+            _rejected.pop(name, None)
+    for rollup in dropped:
+        (backend,) = list(ibis.client.find_backends(rollup.table))
+        drop_table(backend, rollup.table.op().name)
+
+
+def _close() -> None:
+    global _closed
+    with _rollups_lock:
+        _closed = True
+    drop_rollups()
+
+
+# Rollups are only useful to this kernel
+atexit.register(_close)
+
+
+def _measure(expr: ibis.Expr, measure: Measure) -> ibis.Expr:
+    op, field = measure
+    if op == "count":
+        return expr.count()
+    column = expr[field]
+    if op == "valid":
+        return column.count()
+    if op == "sum":
+        # So means computed from the sums are not rounded
+        return column.sum().cast("double")
+    return getattr(column, op)()
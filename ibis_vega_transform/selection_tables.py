@@ -0,0 +1,200 @@
+"""
+Tables holding the values of large point selections, so a filter on them is a
+join with the table instead of a long list of values in the query.
+
+The tables are named after the session of this kernel, which only drops the
+tables it created, and drops all of them when it exits.
+"""
+import atexit
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import threading
+import typing
+
+import ibis
+import ibis.client
+import pandas
+
+from .cache import expression_cache
+from .globals import SESSION_ID
+from .pool import drop_table, ibis_omniscidb, pooled_connection
+from .tracer import tracer
+
+if typing.TYPE_CHECKING:
+    from ibis.omniscidb.client import OmniSciDBClient
+
+__all__ = ["selection_table", "hold_selection_tables", "drop_selection_tables"]
+
+logger = logging.getLogger(__name__)
+
+# Number of selection tables to keep around, so that unchanged selections
+# reuse their table
+MAX_TABLES = 16
+
+TABLE_PREFIX = f"ibis_vega_selection_{SESSION_ID}_"
+
+_TableKey = typing.Tuple[int, str]
+_Table = typing.Tuple["OmniSciDBClient", str]
+
+_tables: "collections.OrderedDict[_TableKey, _Table]" = collections.OrderedDict()
+_tables_lock = threading.Lock()
+# Tables being created, so concurrent queries wait for the same one
+_creating: typing.Dict[_TableKey, threading.Lock] = {}
+# Evicted tables, which are dropped once no query that may read them is running
+_retired: typing.Dict[_TableKey, _Table] = {}
+_running = 0
+
+
+def selection_table(
+    expr: ibis.Expr, field: str, values: typing.List[typing.Any]
+) -> typing.Optional[ibis.Expr]:
+    """
+    A table with a column `field` holding the values, in the database of the
+    expression.
+
+    Tables are named after a hash of their values, and reused while they are
+    among the `MAX_TABLES` most recently used ones. Returns None if the
+    expression is not backed by OmniSci, or if the table can't be created,
+    so the caller lists the values instead.
+    """
+    (backend,) = list(ibis.client.find_backends(expr))
+    if not isinstance(backend, ibis_omniscidb.OmniSciDBClient):
+        return None
+    schema = ibis.schema([(field, expr[field].type())])
+    values = list(dict.fromkeys(values))
+    digest = hashlib.sha1(
+        json.dumps([field, str(schema[field]), values], default=str).encode()
+    ).hexdigest()
+    name = TABLE_PREFIX + digest[:24]
+    key = (id(backend), name)
+    with _tables_lock:
+        if key in _tables:
+            _tables.move_to_end(key)
+            lock = None
+        else:
+            lock = _creating.setdefault(key, threading.Lock())
+    if lock is not None:
+        # The table is created outside of the lock of all tables, so queries
+        # using other tables don't wait for it
+        with lock:
+            data = pandas.DataFrame({field: values})
+            try:
+                _ensure(key, backend, name, schema, data)
+            except Exception:
+                # Like when we may not create tables in the database
+                logger.warning(
+                    "Failed to create selection table %s", name, exc_info=True
+                )
+                return None
+    # Build the table expression from the schema we know, instead of asking
+    # the database for it
+    return backend.table_expr_class(backend.table_class(name, schema, backend))
+
+
+def _ensure(
+    key: _TableKey,
+    backend: "OmniSciDBClient",
+    name: str,
+    schema: ibis.Schema,
+    data: pandas.DataFrame,
+) -> None:
+    """
+    Create the table unless another thread already did, and evict the least
+    recently used tables.
+    """
+    with _tables_lock:
+        if key in _tables:
+            return
+        if key in _retired:
+            # Evicted, but not dropped yet
+            _tables[key] = _retired.pop(key)
+            _creating.pop(key, None)
+            return
+    try:
+        _create(backend, name, schema, data)
+    except Exception:
+        with _tables_lock:
+            _creating.pop(key, None)
+        raise
+    with _tables_lock:
+        _tables[key] = (backend, name)
+        _creating.pop(key, None)
+        evicted = len(_tables) > MAX_TABLES
+        while len(_tables) > MAX_TABLES:
+            evicted_key, table = _tables.popitem(last=False)
+            _retired[evicted_key] = table
+        dropped = _take_retired()
+    if evicted:
+        # Memoized expressions may reference the evicted tables
+        expression_cache.invalidate()
+    for backend, name in dropped:
+        drop_table(backend, name)
+
+
+@contextlib.contextmanager
+def hold_selection_tables() -> typing.Iterator[None]:
+    """
+    Keep the selection tables evicted while the `with` block runs until it is
+    done, since the queries it executes may still read them.
+    """
+    global _running
+    with _tables_lock:
+        _running += 1
+    try:
+        yield
+    finally:
+        with _tables_lock:
+            _running -= 1
+            dropped = _take_retired()
+        for backend, name in dropped:
+            drop_table(backend, name)
+
+
+def _take_retired() -> typing.List[_Table]:
+    """
+    The evicted tables which can be dropped, since no query is running.
+    Called with the lock held.
+    """
+    if _running:
+        return []
+    tables = list(_retired.values())
+    _retired.clear()
+    return tables
+
+
+def drop_selection_tables() -> None:
+    """
+    Drop every selection table created by this kernel.
+    """
+    with _tables_lock:
+        tables = list(_tables.values()) + list(_retired.values())
+        _tables.clear()
+        _retired.clear()
+    for backend, name in tables:
+        drop_table(backend, name)
+    expression_cache.invalidate()
+
+
+# Selection tables are only useful to this kernel
+atexit.register(drop_selection_tables)
+
+
+def _create(
+    backend: "OmniSciDBClient",
+    name: str,
+    schema: ibis.Schema,
+    data: pandas.DataFrame,
+) -> None:
+    with tracer.start_span("selection_table:create") as span:
+        span.log_kv({"table": name, "rows": len(data)})
+        with pooled_connection(backend) as client:
+            client.create_table(name, schema=schema)
+            try:
+                client.load_data(name, data)
+            except Exception:
+                # Don't leave a partially loaded table behind
+                client.drop_table(name, force=True)
+                raise
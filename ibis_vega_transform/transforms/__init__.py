@@ -2,5 +2,6 @@ from .aggregate import aggregate
 from .collect import collect
 from .filter import filter
 from .formula import formula
+from .project import project
 from .bin import bin
 from .timeunit import timeunit
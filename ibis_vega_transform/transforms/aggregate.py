@@ -4,7 +4,12 @@ import ibis
 import ibis.expr.types as it
 
 
-def aggregate(transform: dict, expr: ibis.Expr) -> ibis.Expr:
+# Ops whose result grows with the number of rows, which are scaled up
+# when aggregating a sample
+SCALED_OPS = {"count", "sum"}
+
+
+def aggregate(transform: dict, expr: ibis.Expr, scale: float = 1.0) -> ibis.Expr:
     """
     Apply a vega aggregate transform to an ibis expression.
     https://vega.github.io/vega/docs/transforms/aggregate/
@@ -15,6 +20,9 @@ def aggregate(transform: dict, expr: ibis.Expr) -> ibis.Expr:
         A JSON-able dictionary representing the vega transform.
     expr: ibis.Expr
         The expression to which to apply the transform.
+    scale: float
+        The factor to multiply counts and sums by, if the expression
+        is a sample of the rows.
 
     Returns
     -------
@@ -29,7 +37,7 @@ def aggregate(transform: dict, expr: ibis.Expr) -> ibis.Expr:
 
     expr = expr.group_by(groupby).aggregate(
         [
-            _aggregate(expr, field, op, as__)
+            _aggregate(expr, field, op, as__, scale)
             for (field, op, as__) in zip(fields, ops, as_)
         ]
     )
@@ -37,7 +45,11 @@ def aggregate(transform: dict, expr: ibis.Expr) -> ibis.Expr:
 
 
 def _aggregate(
-    expr: ibis.Expr, field: str, op: str, name: Optional[str] = None
+    expr: ibis.Expr,
+    field: str,
+    op: str,
+    name: Optional[str] = None,
+    scale: float = 1.0,
 ) -> ibis.Expr:
     """
     Apply an aggregation operation to an expression.
@@ -54,12 +66,18 @@ def _aggregate(
         Not all operations are implemented here.
     name: Optional[str]
         A name for the new aggregated value.
+    scale: float
+        The factor to multiply counts and sums by.
     """
     expr = expr[field] if field else expr
     operation = _translate_op(op)
     if not operation:
         raise ValueError(f"Unsupported op {op}")
     expr = operation(expr)
+    if scale != 1 and op in SCALED_OPS:
+        expr = expr * scale
+        if op == "count":
+            expr = expr.round()
     return expr.name(name) if name else expr
 
 
@@ -3,6 +3,9 @@ from typing import *
 import ibis
 from mypy_extensions import TypedDict
 from typing_extensions import Literal
+from ..cache import extent_cache
+from ..params import current_params
+from ..pool import execute_pooled
 from ..tracer import tracer
 
 __all__ = ["bin"]
@@ -37,14 +40,7 @@ def bin(transform: BinTransform, expr: ibis.Expr) -> ibis.Expr:
     # Precompute min/max or else we get
     # "Expression 'xxx' is not being grouped"
     # errors
-    with tracer.start_span("bin_transform:min") as span:
-        min_expr = extent.min()
-        span.log_kv({"sql": min_expr.compile()})
-        min_ = min_expr.execute()
-    with tracer.start_span("bin_transform:max") as span:
-        max_expr = extent.max()
-        span.log_kv({"sql": max_expr.compile()})
-        max_ = max_expr.execute()
+    min_, max_ = _extent(expr, transform["extent"])
 
     # Cast these to floats to work around
     # https://github.com/ibis-project/ibis/issues/1934
@@ -61,5 +57,26 @@ def bin(transform: BinTransform, expr: ibis.Expr) -> ibis.Expr:
     )
 
 
+def _extent(expr: ibis.Expr, field: str) -> Tuple[Any, Any]:
+    """
+    Get the min and max of a field in one query. The extents are cached by the
+    query, since they don't change on most interactions.
+    """
+    extent_expr = expr.aggregate(
+        [expr[field].min().name("min"), expr[field].max().name("max")]
+    )
+    sql = extent_expr.compile(params=current_params())
+    key = ("extent", sql)
+    cached = extent_cache.get(key)
+    if cached is not None:
+        return cached
+    with tracer.start_span("bin_transform:extent") as span:
+        span.log_kv({"sql": sql})
+        (row,) = execute_pooled(extent_expr).to_dict("records")
+    extent = row["min"], row["max"]
+    extent_cache.put(key, extent, len(sql))
+    return extent
+
+
 def _float(value) -> ibis.Expr:
     return ibis.literal(value, "float64").cast("float32")
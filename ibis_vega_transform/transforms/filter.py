@@ -1,8 +1,12 @@
+import typing
+
 import ibis
-from ibis_vega_transform.vegaexpr import eval_vegajs
+from ibis_vega_transform.vegaexpr import Bindings, eval_vegajs
 
 
-def filter(transform: dict, expr: ibis.Expr) -> ibis.Expr:
+def filter(
+    transform: dict, expr: ibis.Expr, bindings: typing.Optional[Bindings] = None
+) -> ibis.Expr:
     """
     Apply a vega filter transform to an ibis expression.
     https://vega.github.io/vega/docs/transforms/filter/
@@ -16,13 +20,15 @@ def filter(transform: dict, expr: ibis.Expr) -> ibis.Expr:
         A JSON-able dictionary representing the vega transform.
     expr: ibis.Expr
         The expression to which to apply the transform.
+    bindings: Optional[Bindings]
+        The data sets the vega expression references, by name.
 
     Returns
     -------
     transformed_expr: the transformed expression
     """
     calc = transform["expr"]
-    test = eval_vegajs(calc, expr)
+    test = eval_vegajs(calc, expr, bindings)
     if test is True:
         return expr
     return expr[test]
@@ -1,8 +1,12 @@
+import typing
+
 import ibis
-from ibis_vega_transform.vegaexpr import eval_vegajs
+from ibis_vega_transform.vegaexpr import Bindings, eval_vegajs
 
 
-def formula(transform: dict, expr: ibis.Expr) -> ibis.Expr:
+def formula(
+    transform: dict, expr: ibis.Expr, bindings: typing.Optional[Bindings] = None
+) -> ibis.Expr:
     """
     Apply a vega formula transform to an ibis expression.
     https://vega.github.io/vega/docs/transforms/formula/
@@ -16,6 +20,8 @@ def formula(transform: dict, expr: ibis.Expr) -> ibis.Expr:
         A JSON-able dictionary representing the vega transform.
     expr: ibis.Expr
         The expression to which to apply the transform.
+    bindings: Optional[Bindings]
+        The data sets the vega expression references, by name.
 
     Returns
     -------
@@ -23,5 +29,5 @@ def formula(transform: dict, expr: ibis.Expr) -> ibis.Expr:
     """
     col = transform["as"]
     calc = transform["expr"]
-    new_col = eval_vegajs(calc, expr).name(col)
+    new_col = eval_vegajs(calc, expr, bindings).name(col)
     return expr.mutate(new_col)
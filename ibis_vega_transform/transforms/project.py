@@ -0,0 +1,27 @@
+import ibis
+
+from ibis_vega_transform.util import promote_list
+
+
+def project(transform: dict, expr: ibis.Expr) -> ibis.Expr:
+    """
+    Apply a vega project transform to an ibis expression.
+    https://vega.github.io/vega/docs/transforms/project/
+
+    Parameters
+    ----------
+    transform: dict
+        A JSON-able dictionary representing the vega transform.
+    expr: ibis.Expr
+        The expression to which to apply the transform.
+
+    Returns
+    -------
+    transformed_expr: the transformed expression
+    """
+    fields = promote_list(transform.get("fields", []))
+    # Without fields, all of them are kept
+    if not fields:
+        return expr
+    as_ = promote_list(transform.get("as", fields))
+    return expr[[expr[field].name(name) for field, name in zip(fields, as_)]]
@@ -7,15 +7,19 @@ import math
 import operator
 import random
 import sys
+import threading
 from typing import *
 
 import altair_transform.utils._evaljs
 import ibis
 import ibis.expr.types as it
 from altair_transform.utils import evaljs
+from altair_transform.utils._parser import Parser
 from mypy_extensions import TypedDict
 from typing_extensions import Literal
 
+from .globals import get_selection_table_threshold
+
 # Monkey patch altair_transform so that boolean operators  work on ibis expression
 
 
@@ -86,11 +90,37 @@ altair_transform.utils._evaljs.BINARY_OPERATORS["!="] = not_equal_operator
 altair_transform.utils._evaljs.BINARY_OPERATORS["!=="] = not_equal_operator
 
 
-def eval_vegajs(expression: str, datum: ibis.Expr = None) -> ibis.Expr:
-    """Evaluate a vega expression"""
+# Data bound to the names of vega data sets, which expressions read with
+# `data(name)` or test with `vlSelectionTest(name, datum)`
+Bindings = Dict[str, List[Any]]
+
+# The parser is not thread safe, and queries are translated on several threads
+_parser = Parser()
+_parser_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_vegajs(expression: str) -> Any:
+    """
+    Parse a vega expression into a syntax tree.
+
+    Expressions are parsed once and cached by their source text, since the data
+    they depend on are bound when they are evaluated.
+    """
+    with _parser_lock:
+        return _parser.parse(expression)
+
+
+def eval_vegajs(
+    expression: str, datum: ibis.Expr = None, bindings: Optional[Bindings] = None
+) -> ibis.Expr:
+    """Evaluate a vega expression, with the data sets it references in `bindings`"""
     namespace = {"datum": datum} if datum is not None else {}
     namespace.update(VEGAJS_NAMESPACE)
-    return evaljs(expression, namespace)
+    if bindings:
+        namespace["data"] = functools.partial(_data, bindings)
+        namespace["vlSelectionTest"] = functools.partial(_selection_test, bindings)
+    return evaljs(parse_vegajs(expression), namespace)
 
 
 # Type Coercion Functions
@@ -361,7 +391,10 @@ def _test_single_point(expr: ibis.Expr, field: FieldDict, value: Any) -> ibis.Ex
     # for some reason this appears as type E even though it should be type R
     if isinstance(column, ibis.expr.types.TemporalValue) and tp == "E":
         tp = "R"
-        value = [dt.datetime.strptime(v, JS_DATETIME_FORMAT) for v in value]
+        value = [
+            dt.datetime.strptime(v, JS_DATETIME_FORMAT) if isinstance(v, str) else v
+            for v in value
+        ]
 
     if tp == "E":
         if isinstance(value, list):
@@ -399,22 +432,78 @@ def vlSelectionTest(
     op: Literal["union", "intersect"] = "union",
 ) -> ibis.Expr:
     """
-    Instead of passing in the data name as the first arg, we pass in the actual data, like:
+    Instead of the data name, the first arg is the data of the selection, like:
 
     >>>  [{'fields': [{'type': 'E', 'field': 'c'}], 'values': ['second']}]
 
+    Expressions evaluated with bindings look up the data by name.
+
     Translated from:
 
     https://github.com/vega/vega/blob/353a4097a5c726ec6b5b1df71722976d246c6cd7/packages/vega-selections/src/selectionTest.js#L50-L63
     """
     if not filters:
         return expr
+    points = point_values(filters) if op == "union" else None
+    if points and not isinstance(expr[points[0]], it.TemporalValue):
+        # Imported here, b/c the pool imports this module through `params`
+        from .selection_tables import selection_table
+
+        field, values = points
+        table = selection_table(expr, field, values)
+        if table is not None:
+            return expr[field].isin(table[field])
     return functools.reduce(
         {"union": operator.or_, "intersect": operator.and_}[op],
         (_test_point(expr, f) for f in filters),
     )
 
 
+def point_values(filters: List[SelectionDict]) -> Optional[Tuple[str, List[Any]]]:
+    """
+    If the selection is a large list of points on a single field, returns the
+    field and the selected values. Otherwise returns None.
+    """
+    threshold = get_selection_table_threshold()
+    if threshold is None:
+        return None
+    field = None
+    values: List[Any] = []
+    for f in filters:
+        if len(f["fields"]) != 1 or f["fields"][0]["type"] != "E":
+            return None
+        if field is not None and f["fields"][0]["field"] != field:
+            return None
+        field = f["fields"][0]["field"]
+        (value,) = f["values"]
+        value = value if isinstance(value, list) else [value]
+        if any(isinstance(v, (ibis.Expr, list, dict)) for v in value):
+            return None
+        values.extend(value)
+    if field is None or len(values) < threshold:
+        return None
+    return field, values
+
+
+def _data(bindings: Bindings, name: str) -> List[Any]:
+    if name not in bindings:
+        raise ValueError(f"Data {name} is not bound")
+    return bindings[name]
+
+
+def _selection_test(
+    bindings: Bindings,
+    name: Union[str, List[SelectionDict]],
+    expr: ibis.Expr,
+    op: Literal["union", "intersect"] = "union",
+) -> ibis.Expr:
+    """
+    `vlSelectionTest` on the selection bound to `name`.
+    """
+    filters = _data(bindings, name) if isinstance(name, str) else name
+    return vlSelectionTest(filters, expr, op)
+
+
 def isValid(value):
     """
     Returns true if value is not null, undefined, or NaN, false otherwise.
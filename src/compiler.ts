@@ -8,6 +8,18 @@ import * as themes from 'vega-themes';
 import { extractTransforms } from './transformextract';
 const COMM_ID = 'ibis_vega_transform:compiler';
 
+/**
+ * A compiled Vega spec, and the comm it was compiled over.
+ */
+export interface ICompiledSpec {
+  spec: object;
+  /**
+   * Keeps the ibis expressions of the spec alive in the kernel,
+   * until it is closed once the view is gone.
+   */
+  comm: Kernel.IComm;
+}
+
 /**
  * Takes in a Vega-Lite spec and returns a compiled Vega spec,
  * with the Vega transforms swapped out for Ibis transforms.
@@ -17,7 +29,7 @@ export async function compileSpec(
   vlSpec: TopLevelSpec,
   span: any,
   rootSpan: any
-): Promise<object> {
+): Promise<ICompiledSpec> {
   // For some reason we have to manually merge in the theme, like this used to do in the vega lite compiler
   // otherwise it will generate an incorrect black background on a white theme
   // https://github.com/vega/vega-lite/commit/7f5969ffefc35e3d583b0dec4b05bc14870747b4
@@ -45,5 +57,5 @@ export async function compileSpec(
   comm.onMsg = msg => transformedSpecPromise.resolve(msg.content.data);
   await comm.open({ spec: vSpec, span, rootSpan } as any).done;
   const finalSpec = await transformedSpecPromise.promise;
-  return finalSpec;
+  return { spec: finalSpec, comm };
 }
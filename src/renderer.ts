@@ -65,6 +65,7 @@ export class IbisVegaRenderer extends Widget implements IRenderMime.IRenderer {
       this._view.finalize();
       this._view = null;
     }
+    this._closeComm();
 
     const compileSpecSpan = tracing
       ? await client.startSpan({
@@ -74,12 +75,13 @@ export class IbisVegaRenderer extends Widget implements IRenderMime.IRenderer {
         })
       : null;
 
-    const vSpec = await compileSpec(
+    const { spec: vSpec, comm } = await compileSpec(
       kernel,
       vlSpec,
       tracing ? await client.injectSpan(compileSpecSpan!) : injectedSpan,
       injectedSpan
     );
+    this._comm = comm;
 
     if (tracing) {
       await client.finishSpan(compileSpecSpan!);
@@ -133,10 +135,23 @@ export class IbisVegaRenderer extends Widget implements IRenderMime.IRenderer {
       this._view.finalize();
       this._view = null;
     }
+    this._closeComm();
+  }
+
+  /**
+   * Close the compiler comm of the rendered spec, which lets the kernel
+   * release its ibis expressions.
+   */
+  private _closeComm(): void {
+    if (this._comm && !this._comm.isDisposed) {
+      this._comm.close();
+    }
+    this._comm = null;
   }
 
   private _isDisposed = false;
   private _view: vega.View | null = null;
+  private _comm: Kernel.IComm | null = null;
   private _renderingSpec = false;
   private _renderedSpec: any = null;
 }
@@ -27,6 +27,84 @@ function parseDates(o: { [key: string]: any }): { [key: string]: any } {
   return n;
 }
 
+/**
+ * A query result encoded per column by the kernel.
+ *
+ * Boolean and number columns are sent as binary buffers, where NaN marks
+ * a missing number. Date columns are ISO strings, and other columns are JSON values.
+ */
+interface IColumnarResult {
+  format: 'columnar';
+  length: number;
+  columns: Array<{
+    name: string;
+    type: 'boolean' | 'number' | 'date' | 'json';
+    buffer?: number;
+    values?: Array<any>;
+  }>;
+}
+
+/**
+ * Copies a binary buffer of a comm message, so that it is aligned for a typed array.
+ */
+function toArrayBuffer(buffer: ArrayBuffer | ArrayBufferView): ArrayBuffer {
+  if (ArrayBuffer.isView(buffer)) {
+    return buffer.buffer.slice(
+      buffer.byteOffset,
+      buffer.byteOffset + buffer.byteLength
+    ) as ArrayBuffer;
+  }
+  return buffer;
+}
+
+/**
+ * Turns a columnar result into the records vega expects.
+ */
+function decodeColumnar(
+  result: IColumnarResult,
+  buffers: Array<ArrayBuffer | ArrayBufferView>
+): Array<{ [key: string]: any }> {
+  const rows: Array<{ [key: string]: any }> = [];
+  for (let i = 0; i < result.length; i++) {
+    rows.push({});
+  }
+  for (const column of result.columns) {
+    const { name } = column;
+    switch (column.type) {
+      case 'boolean': {
+        const values = new Uint8Array(toArrayBuffer(buffers[column.buffer!]));
+        for (let i = 0; i < result.length; i++) {
+          rows[i][name] = values[i] === 1;
+        }
+        break;
+      }
+      case 'number': {
+        const values = new Float64Array(toArrayBuffer(buffers[column.buffer!]));
+        for (let i = 0; i < result.length; i++) {
+          const value = values[i];
+          rows[i][name] = isNaN(value) ? null : value;
+        }
+        break;
+      }
+      case 'date': {
+        const values = column.values!;
+        for (let i = 0; i < result.length; i++) {
+          const value = values[i];
+          rows[i][name] = value === null ? null : Date.parse(value);
+        }
+        break;
+      }
+      default: {
+        const values = column.values!;
+        for (let i = 0; i < result.length; i++) {
+          rows[i][name] = values[i];
+        }
+      }
+    }
+  }
+  return rows;
+}
+
 /**
  * The possible states our transform can be in.
  *
@@ -55,14 +133,189 @@ const enum StateEnum {
   fetched = 'fetched'
 }
 // Add way to throw away data if wrong returned
+//
+// When a result is streamed, `append` is set on the batches after the first,
+// so they are added to the existing data instead of replacing it.
+// Data sent after a preview replaces it, so `append` is not set on them.
 type State =
   | { state: StateEnum.initial }
-  | { state: StateEnum.fetching; aborted: boolean }
-  | { state: StateEnum.fetched; data: Array<object> };
+  | { state: StateEnum.fetching } & FetchSignal
+  | { state: StateEnum.fetched; data: Array<object>; append: boolean };
+
+/**
+ * Marks a fetch as aborted. If `cancel` is set, calling it asks the kernel
+ * to stop running the query.
+ */
+type FetchSignal = { aborted: boolean; cancel?: () => void };
+
+/**
+ * Decodes the content of a result message from the kernel.
+ */
+function decodeResult(
+  data: any,
+  buffers: Array<ArrayBuffer | ArrayBufferView>
+): Array<object> {
+  if (Array.isArray(data)) {
+    return (data as JSONObject[]).map(parseDates);
+  }
+  return decodeColumnar(data, buffers);
+}
+
+/**
+ * A query waiting to be sent to the kernel.
+ */
+interface IQueryRequest {
+  parameters: any;
+  /**
+   * Called with data received after the promise resolved, which is either
+   * added to the previous data, or replaces a preview.
+   */
+  onBatch: (batch: Array<object>, append: boolean) => void;
+  result: PromiseDelegate<Array<object> | null>;
+  /**
+   * Set once the query was sent, to ask the kernel to stop running it.
+   */
+  sendCancel?: () => void;
+}
+
+/**
+ * Queries requested since the last flush, which will be sent to the kernel together.
+ */
+let pendingRequests: IQueryRequest[] = [];
+
+/**
+ * Queue a query, to be sent with all other queries requested in the same pulse.
+ *
+ * Returns a function which cancels the query.
+ */
+function queueQuery(
+  kernel: Kernel.IKernelConnection,
+  request: IQueryRequest
+): () => void {
+  pendingRequests.push(request);
+  if (pendingRequests.length === 1) {
+    setTimeout(() => {
+      const requests = pendingRequests;
+      pendingRequests = [];
+      if (requests.length === 1) {
+        void sendQuery(kernel, requests[0]);
+      } else if (requests.length > 1) {
+        void sendBatch(kernel, requests);
+      }
+    }, 0);
+  }
+  return () => {
+    const index = pendingRequests.indexOf(request);
+    if (index !== -1) {
+      pendingRequests.splice(index, 1);
+    } else if (request.sendCancel) {
+      request.sendCancel();
+    }
+    request.result.resolve(null);
+  };
+}
+
+/**
+ * Creates a handler for the messages the kernel sends about one query: a
+ * preview, streamed batches, and then the result, or a cancellation or error.
+ */
+function handleMessages(
+  request: IQueryRequest
+): (data: any, buffers: Array<ArrayBuffer | ArrayBufferView>) => void {
+  let receivedBatch = false;
+  let receivedPreview = false;
+  return (data, buffers) => {
+    if (Array.isArray(data) || data.format === 'columnar') {
+      const result = decodeResult(data, buffers);
+      if (receivedPreview) {
+        request.onBatch(result, false);
+      } else {
+        request.result.resolve(result);
+      }
+    } else if ('preview' in data) {
+      receivedPreview = true;
+      request.result.resolve(decodeResult(data.preview, buffers));
+    } else if ('batch' in data) {
+      const batch = decodeResult(data.batch, buffers);
+      if (receivedBatch) {
+        request.onBatch(batch, true);
+      } else if (receivedPreview) {
+        receivedBatch = true;
+        request.onBatch(batch, false);
+      } else {
+        receivedBatch = true;
+        request.result.resolve(batch);
+      }
+    } else if (data.streamed) {
+      // The result was already sent in batches
+      return;
+    } else {
+      if (data.error) {
+        console.error('Ibis query failed', data.error);
+      }
+      // The query was cancelled or failed on the kernel
+      request.result.resolve(null);
+    }
+  };
+}
 
+/**
+ * Sends a single query on its own `queryibis` comm.
+ */
+async function sendQuery(
+  kernel: Kernel.IKernelConnection,
+  request: IQueryRequest
+): Promise<void> {
+  const comm = kernel.createComm('queryibis');
+  const onMessage = handleMessages(request);
+  comm.onMsg = msg => onMessage(msg.content.data, msg.buffers || []);
+  await comm.open(request.parameters).done;
+  request.sendCancel = () => comm.send({ type: 'cancel' });
+}
+
+/**
+ * Sends several queries on one `queryibis:batch` comm, which answers
+ * all of them with a single message. Previews and streamed batches are
+ * sent for each query as they are ready.
+ */
+async function sendBatch(
+  kernel: Kernel.IKernelConnection,
+  requests: IQueryRequest[]
+): Promise<void> {
+  const comm = kernel.createComm('queryibis:batch');
+  const handlers = requests.map(handleMessages);
+  comm.onMsg = msg => {
+    const data = msg.content.data as any;
+    const buffers = msg.buffers || [];
+    if (!('results' in data)) {
+      const { index, ...message } = data;
+      handlers[index](message, buffers);
+      return;
+    }
+    data.results.forEach(
+      ({ result, buffers: [start, count] }: any, index: number) => {
+        handlers[index](result, buffers.slice(start, start + count));
+      }
+    );
+  };
+  await comm.open({ queries: requests.map(r => r.parameters) }).done;
+  requests.forEach((request, index) => {
+    request.sendCancel = () => comm.send({ type: 'cancel', index });
+  });
+}
+
+/**
+ * Fetches the result of a query from the kernel.
+ *
+ * If the kernel streams the result, the returned promise resolves with the first
+ * batch and the remaining batches are passed to `onBatch` as they arrive.
+ * If it sends a preview first, the promise resolves with the preview, and
+ * the exact result is passed to `onBatch` to replace it.
+ */
 async function getData(
   parameters: any,
-  abortSignal: { aborted: boolean }
+  abortSignal: FetchSignal,
+  onBatch: (batch: Array<object>, append: boolean) => void
 ): Promise<null | Array<object>> {
   const { tracing, kernel } = QueryIbis;
   if (!kernel) {
@@ -87,13 +340,6 @@ async function getData(
     return null;
   }
 
-  // Fetch the query results from the kernel.
-  const comm = kernel.createComm('queryibis');
-
-  const resultPromise = new PromiseDelegate<JSONObject[]>();
-  comm.onMsg = msg =>
-    resultPromise.resolve((msg.content.data as any) as JSONObject[]);
-
   // set span inside comm to be this comm message instead of root span
   if (tracing) {
     parameters = { ...parameters, span: await client.injectSpan(spanExtract!) };
@@ -103,25 +349,25 @@ async function getData(
     return null;
   }
 
-  await comm.open(parameters).done;
-
-  if (abortSignal.aborted) {
-    await cleanup();
-    return null;
-  }
-
-  const result: JSONObject[] = await resultPromise.promise;
-  if (abortSignal.aborted) {
-    await cleanup();
-    return null;
-  }
-  const parsedResult = result.map(parseDates);
+  // Fetch the query results from the kernel, and interrupt the query
+  // on the kernel if we are aborted while waiting for it
+  const request: IQueryRequest = {
+    parameters,
+    onBatch: (batch, append) => {
+      if (!abortSignal.aborted) {
+        onBatch(batch, append);
+      }
+    },
+    result: new PromiseDelegate<Array<object> | null>()
+  };
+  abortSignal.cancel = queueQuery(kernel, request);
 
+  const result = await request.result.promise;
   await cleanup();
   if (abortSignal.aborted) {
     return null;
   }
-  return parsedResult;
+  return result;
 }
 
 const TRANSFORM = 'queryibis';
@@ -137,8 +383,15 @@ class QueryIbis extends dataflow.Transform implements vega.Transform {
   constructor(params: any) {
     super([], params);
     this._state = { state: StateEnum.initial };
+    this._source = String(QueryIbis._nextSource++);
   }
 
+  /**
+   * Counter used to give each transform instance a unique data source id,
+   * so the kernel can cancel superseded queries for the same data source.
+   */
+  private static _nextSource = 0;
+
   /**
    * The current kernel instance for the QueryIbis transform.
    */
@@ -178,6 +431,11 @@ class QueryIbis extends dataflow.Transform implements vega.Transform {
         name: 'span',
         type: 'object',
         required: false
+      },
+      {
+        name: 'downsample',
+        type: 'object',
+        required: false
       }
     ]
   };
@@ -185,18 +443,34 @@ class QueryIbis extends dataflow.Transform implements vega.Transform {
   transform(parameters: any, pulse: any): any {
     if (this._state.state === StateEnum.fetched) {
       // update state and return pulse
-      return this.output(pulse, this._state.data);
+      return this.output(pulse, this._state.data, this._state.append);
     }
-    if (this._state.state === StateEnum.fetching) {
-      this._state.aborted = true;
+    // Abort the previous fetch, which may still be streaming batches
+    if (this._fetch) {
+      this._fetch.aborted = true;
+      if (this._fetch.cancel) {
+        this._fetch.cancel();
+      }
     }
 
-    this._state = { state: StateEnum.fetching, aborted: false };
+    const signal = { state: StateEnum.fetching as const, aborted: false };
+    this._state = this._fetch = signal;
+    const flow = pulse.dataflow;
+
+    // Add streamed batches to the data as they arrive, or replace the preview
+    const onBatch = (batch: Array<object>, append: boolean) => {
+      this._state = { state: StateEnum.fetched, data: batch, append };
+      flow.touch(this).run();
+    };
 
     // return promise for non-blocking async loading
-    const p = getData(parameters, this._state).then(res => {
+    const p = getData(
+      { ...parameters, source: this._source, encoding: 'columnar' },
+      signal,
+      onBatch
+    ).then(res => {
       if (res) {
-        this._state = { state: StateEnum.fetched, data: res };
+        this._state = { state: StateEnum.fetched, data: res, append: false };
         return (df: any) => df.touch(this);
       }
       /* tslint:disable:no-empty */
@@ -209,17 +483,24 @@ class QueryIbis extends dataflow.Transform implements vega.Transform {
    * Copied from
    * https://github.com/vega/vega/blob/d5b979955f67c9557b97eb5ddebb3fef48fe736c/packages/vega-transforms/src/Load.js#L52-L59
    */
-  output(pulse: any, data: any) {
+  output(pulse: any, data: any, append = false) {
     data.forEach(dataflow.ingest);
     // tslint:disable-next-line:no-bitwise
     const out = pulse.fork(pulse.NO_FIELDS & pulse.NO_SOURCE);
-    out.rem = this.value;
-    this.value = out.source = out.add = data;
+    if (append) {
+      this.value = out.source = this.value.concat(data);
+      out.add = data;
+    } else {
+      out.rem = this.value;
+      this.value = out.source = out.add = data;
+    }
     this._state = { state: StateEnum.initial };
     return out;
   }
 
   private _state: State;
+  private _fetch: FetchSignal | null = null;
+  private _source: string;
   private value: any;
 }
 
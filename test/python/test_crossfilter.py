@@ -0,0 +1,62 @@
+import pytest
+
+pandas = pytest.importorskip("pandas")
+ibis = pytest.importorskip("ibis")
+
+from ibis_vega_transform.core import apply  # noqa: E402
+from ibis_vega_transform.crossfilter import crossfilter_query  # noqa: E402
+from ibis_vega_transform.globals import set_crossfilter_resolution  # noqa: E402
+
+TRANSFORMS = [
+    {
+        "type": "bin",
+        "field": "x",
+        "as": ["bin_x", "bin_x_end"],
+        "maxbins": 10,
+        "extent": "x",
+    },
+    {
+        "type": "filter",
+        "expr": '!length(data("brush_store")) || vlSelectionTest("brush_store", datum)',
+    },
+    {
+        "type": "aggregate",
+        "groupby": ["bin_x", "bin_x_end"],
+        "ops": ["count"],
+        "fields": [None],
+        "as": ["count"],
+    },
+]
+
+
+@pytest.fixture
+def resolution():
+    set_crossfilter_resolution(100)
+    yield
+    set_crossfilter_resolution(None)
+
+
+def test_index_matches_exact_query_with_nulls_in_the_brushed_field(resolution):
+    # The rows with the extremes of x are missing y, so x is binned differently
+    # if they are left out
+    df = pandas.DataFrame(
+        {
+            "x": [0.0] + [float(i) for i in range(10, 90)] + [100.0],
+            "y": [None] + [float(i % 7) for i in range(10, 90)] + [None],
+        }
+    )
+    expr = ibis.pandas.connect({"t": df}).table("t")
+    bindings = {
+        "brush_store": [
+            {"fields": [{"type": "R", "field": "y"}], "values": [[0.0, 6.0]]}
+        ]
+    }
+    indexed = crossfilter_query(expr, "t", TRANSFORMS, bindings)
+    exact = apply(expr, TRANSFORMS, bindings=bindings).execute()
+
+    def normalize(data):
+        data = data[["bin_x", "bin_x_end", "count"]].astype("float64")
+        return data.sort_values("bin_x").reset_index(drop=True)
+
+    assert indexed is not None
+    pandas.testing.assert_frame_equal(normalize(indexed), normalize(exact))
@@ -0,0 +1,25 @@
+import pytest
+
+pandas = pytest.importorskip("pandas")
+ibis = pytest.importorskip("ibis")
+
+from ibis_vega_transform.downsample import downsample  # noqa: E402
+
+
+def test_m4_keeps_one_row_per_extreme_when_y_is_constant():
+    rows = 1000
+    df = pandas.DataFrame({"x": range(rows), "y": [1.0] * rows, "s": ["a"] * rows})
+    expr = ibis.pandas.connect({"t": df}).table("t")
+    spec = {
+        "mark": "line",
+        "x": "x",
+        "y": "y",
+        "groupby": ["s"],
+        "width": 10,
+        "height": 10,
+    }
+    result = downsample(expr, spec).execute()
+    # At most the first and last x and the min and max y of each pixel column
+    assert 0 < len(result) <= 4 * spec["width"]
+    assert list(result.columns) == list(df.columns)
+    assert result["x"].is_monotonic_increasing
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+pytest.importorskip("ibis")
+
+from ibis_vega_transform import pool  # noqa: E402
+from ibis_vega_transform.cancel import (  # noqa: E402
+    CancelToken,
+    QueryCancelled,
+    use_token,
+)
+
+
+class Client:
+    def __init__(self, token):
+        self.con = self
+        self.token = token
+        self.fetches = 0
+
+    def execute(self, sql):
+        self.description = [("a",)]
+        return self
+
+    def fetchmany(self, size):
+        self.fetches += 1
+        if self.fetches == 1:
+            return [(1,)] * size
+        # The query is cancelled while it is fetched, which closes the
+        # connection, so the cursor returns no more rows
+        self.token.cancel()
+        return []
+
+
+class Expr:
+    def compile(self, params=None):
+        return "SELECT a FROM t"
+
+
+def test_iter_batches_pooled_raises_when_cancelled_during_the_last_fetch(
+    monkeypatch,
+):
+    token = CancelToken()
+    client = Client(token)
+    monkeypatch.setattr(pool.ibis_omniscidb, "OmniSciDBClient", Client)
+    monkeypatch.setattr(pool.ibis.client, "find_backends", lambda expr: [client])
+    monkeypatch.setattr(
+        pool, "_get_pool", lambda backend: pool.ConnectionPool(lambda: client)
+    )
+    with use_token(token):
+        batches = pool.iter_batches_pooled(Expr(), 2)
+        assert len(next(batches)) == 2
+        with pytest.raises(QueryCancelled):
+            list(batches)
+
+
+def test_idle_connections_are_closed_without_further_checkouts():
+    closed = []
+    connections = pool.ConnectionPool(
+        object, min_size=0, max_size=2, idle_timeout=0.05, close=closed.append
+    )
+    with connections.connection():
+        pass
+    time.sleep(0.5)
+    assert len(closed) == 1
@@ -0,0 +1,68 @@
+import pytest
+
+pandas = pytest.importorskip("pandas")
+ibis = pytest.importorskip("ibis")
+
+from ibis_vega_transform import query  # noqa: E402
+from ibis_vega_transform.globals import (  # noqa: E402
+    set_preview_sample,
+    set_stream_batch_size,
+)
+from ibis_vega_transform.registry import expression_registry  # noqa: E402
+
+
+class Comm:
+    def __init__(self):
+        self.messages = []
+
+    def on_msg(self, callback):
+        pass
+
+    def send(self, data, buffers=None):
+        self.messages.append(data)
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    monkeypatch.setattr(query, "ENABLE_MULTIPROCESSING", False)
+    yield
+    set_preview_sample(None)
+    set_stream_batch_size(None)
+
+
+def _count_by(name, field):
+    return {
+        "name": name,
+        "span": {},
+        "encoding": "json",
+        "transform": [
+            {
+                "type": "aggregate",
+                "groupby": [field],
+                "ops": ["count"],
+                "fields": [None],
+                "as": ["count"],
+            }
+        ],
+    }
+
+
+def test_batched_pulse_sends_previews_and_streams(settings):
+    df = pandas.DataFrame({"a": [1, 1, 2, 3] * 50, "b": ["x", "y"] * 100})
+    name = expression_registry.register(ibis.pandas.connect({"t": df}).table("t"))
+    set_preview_sample(0.999)
+    set_stream_batch_size(2)
+    comm = Comm()
+    msg = {"content": {"data": {"queries": [_count_by(name, "a"), _count_by(name, "b")]}}}
+    query.batch_query_target_func(comm, msg)
+
+    for index, field in enumerate(["a", "b"]):
+        sent = [m for m in comm.messages if m.get("index") == index]
+        assert "preview" in sent[0]
+        batches = [m for m in sent if "batch" in m]
+        assert [m["done"] for m in batches][-1] is True
+        rows = [row for m in batches for row in m["batch"]]
+        assert len(rows) == df[field].nunique()
+
+    (results,) = [m for m in comm.messages if "results" in m]
+    assert [r["result"] for r in results["results"]] == [{"streamed": True}] * 2
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("ibis")
+
+from ibis_vega_transform.rollup import COUNT, requirements  # noqa: E402
+
+
+def test_requirements_include_the_extent_field_of_bins():
+    transforms = [
+        {
+            "type": "bin",
+            "field": "x",
+            "as": ["bin_x", "bin_x_end"],
+            "maxbins": 10,
+            "extent": "y",
+        },
+        {
+            "type": "aggregate",
+            "groupby": ["bin_x", "bin_x_end"],
+            "ops": ["count"],
+            "fields": [None],
+            "as": ["count"],
+        },
+    ]
+    assert requirements(transforms, {}) == ({"x", "y"}, {COUNT})